@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Event-loop version of ping.Pinger, so that pinging can share an
+# asyncio (or, on Python 2, trollius) loop with other monitoring tasks.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import collections
+import os
+import socket
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from ping import EchoRequest, IcmpSocket, monotonic, readReplies
+
+class AsyncPinger:
+    '''Pings hosts from within an event loop. The ICMP socket is registered
+       with the loop, and each probe is represented only by a future, so
+       thousands can be in flight at once. A single timer handles all the
+       timeouts.'''
+    def __init__(self, loop=None, timeout=1.0, packet_size=56, sock=None):
+        if loop == None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.timeout = timeout
+        self.own_id = os.getpid() & 0xFFFF
+        self.payload = "\x55" * packet_size
+        self.seq_number = 0
+        if sock == None:
+            sock = IcmpSocket()
+        self.socket = sock
+        self.buffer = bytearray(2048)
+
+        self.reqs = {}                       # pkid -> (req, future)
+        self.waiting = collections.deque()   # (deadline, pkid, req), in send order
+        self.timer = None
+        self.loop.add_reader(self.socket.fileno(), self._onReadable)
+
+    def close(self):
+        self.loop.remove_reader(self.socket.fileno())
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        for (req, future) in self.reqs.values():
+            if not future.done():
+                future.cancel()
+        self.reqs = {}
+        self.waiting.clear()
+
+    #--------------------------------------------------------------------------
+
+    def ping(self, host):
+        '''Returns a future whose result is the EchoRequest sent to host,
+           once it has been answered or has timed out'''
+        future = asyncio.Future(loop=self.loop)
+        self._send(host, future)
+        return future
+
+    def sweep(self, hosts, rate=None):
+        '''Pings each of hosts, at 'rate' packets per second (or all at once
+           if rate is None). Returns a future whose result is the list of
+           EchoRequests, in the same order as hosts.'''
+        futures = [ asyncio.Future(loop=self.loop) for host in hosts ]
+        if rate:
+            self._pace(hosts, futures, 0, 1.0 / rate, monotonic())
+        else:
+            for (host, future) in zip(hosts, futures):
+                self._send(host, future)
+        return asyncio.gather(*futures)
+
+    #--------------------------------------------------------------------------
+
+    def _pace(self, hosts, futures, idx, interval, nextSend):
+        now = monotonic()
+        while idx < len(hosts) and nextSend <= now:
+            self._send(hosts[idx], futures[idx])
+            idx += 1
+            nextSend += interval
+        if idx < len(hosts):
+            self.loop.call_later(nextSend - now, self._pace, hosts, futures, idx, interval, nextSend)
+
+    def _send(self, host, future):
+        if future.done():
+            return  # Cancelled before we got to it
+        self.seq_number = (self.seq_number + 1) & 0xFFFF
+        req = EchoRequest(host, self.own_id, self.seq_number, self.payload)
+        try:
+            req.send(self.socket)
+        except socket.error as e:
+            print "Socket error:", str(e), "-- continuing anyway"
+            future.set_result(req)
+            return
+        pkid = req.getId()
+        old = self.reqs.get(pkid)
+        if old != None and not old[1].done():
+            # Still waiting after 64K more probes; give up on it, as
+            # Pinger.sweep() does, rather than lose its future
+            old[1].set_result(old[0])
+        self.reqs[pkid] = (req, future)
+        self.waiting.append( (req.sendTime + self.timeout, pkid, req) )
+        if self.timer == None:
+            self._setTimer()
+
+    def _setTimer(self):
+        if len(self.waiting) > 0:
+            self.timer = self.loop.call_later(max(self.waiting[0][0] - monotonic(), 0.0), self._onTimer)
+        else:
+            self.timer = None
+
+    def _onTimer(self):
+        now = monotonic()
+        while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+            (deadline, pkid, req) = self.waiting.popleft()
+            entry = self.reqs.get(pkid)
+            # The ID may have been reused since by a later probe
+            if entry != None and entry[0] is req:
+                del self.reqs[pkid]
+                if not entry[1].done():
+                    entry[1].set_result(req)
+        self._setTimer()
+
+    def _onReadable(self):
+        for (pkid, stamp, receiveClock, fromAddr, packet) in readReplies(self.socket, self.buffer):
+            entry = self.reqs.get(pkid)
+            if entry == None:
+                continue
+            (req, future) = entry
+            if req.checkResponse(stamp, receiveClock, fromAddr, packet):
+                del self.reqs[pkid]
+                if not future.done():
+                    future.set_result(req)
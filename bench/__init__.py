@@ -0,0 +1,17 @@
+# Benchmarks for ping.py, pinggraph.py and mkgraph.py. These run offline,
+# without root or raw sockets: see run.py.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import os
+import sys
+
+class Quiet:
+    '''Swallows what the code being run prints'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# In-process stand-in for ping.IcmpSocket, which answers every
+# ECHO_REQUEST sent to it, so that ping.Pinger can be run without root.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import os
+import time
+import fcntl
+import socket
+import struct
+import collections
+
+from ping import EchoRequest
+
+def makeReply(packet, addr, ident=None):
+    '''Returns the IP packet a host at addr would send back for the
+       ECHO_REQUEST packet; ident replaces the request's if given'''
+    (icmpType, code, csum, reqIdent, sequence) = struct.unpack_from("!BBHHH", packet)
+    if ident == None:
+        ident = reqIdent
+    icmp = struct.pack("!BBHHH", EchoRequest.ICMP_ECHOREPLY, 0, 0, ident, sequence) + packet[8:]
+    icmp = icmp[:2] + struct.pack("H", EchoRequest.getChecksum(icmp)) + icmp[4:]
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(icmp), 0, 0, 64, 1, 0,
+                         "\x00" * 4, socket.inet_aton(addr))
+    return header + icmp
+
+class EchoSocket:
+    '''Queues an ECHO_REPLY, from the address pinged, for each packet
+       sent. A pipe is kept readable while there are replies waiting, so
+       the socket works with select().'''
+    def __init__(self):
+        self.replies = collections.deque()
+        (self.rfd, self.wfd) = os.pipe()
+        fcntl.fcntl(self.rfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.sent = 0
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+    def fileno(self):
+        return self.rfd
+
+    def sendto(self, packet, addr):
+        self.sent += 1
+        if len(self.replies) == 0:
+            os.write(self.wfd, "x")
+        self.replies.append( (makeReply(packet, addr[0]), (addr[0], 0)) )
+        return len(packet)
+
+    def receive(self, buf):
+        if len(self.replies) == 0:
+            return None
+        (reply, fromAddr) = self.replies.popleft()
+        if len(self.replies) == 0:
+            os.read(self.rfd, 1)
+        buf[:len(reply)] = reply
+        return (len(reply), fromAddr, time.time())
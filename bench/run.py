@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+# Times the hot paths of ping.py, pinggraph.py and mkgraph.py on
+# synthetic data, and writes the results as JSON so that runs from
+# different commits can be compared. Needs no network, and no root.
+#
+# Run from the top of the source tree:
+#   python -m bench.run [-o results.json] [-c previous.json] [benchmark ...]
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import sys
+import os
+import time
+import json
+import getopt
+import shutil
+import platform
+import tempfile
+import subprocess
+import timeit
+import StringIO
+
+import site_config
+import ping
+import pinglog
+import mkgraph
+import pinggraph
+from mkgraph import TimeSeries
+
+from bench import synthlog, Quiet
+from bench.fakesocket import EchoSocket
+
+class Context:
+    '''Settings and scratch space shared by the benchmarks'''
+    # A "wide" log has this many times the hosts, each pinged this many
+    # times less often, so it has as many records spread over more devices
+    WIDE = 50
+
+    def __init__(self, nhosts, workDir):
+        self.nhosts = nhosts
+        self.workDir = workDir
+        self.date = time.strftime("%Y%m%d")
+        self.logs = {}
+
+    def getLog(self, binary=False, wide=False):
+        '''Returns the name of a synthetic day's log, writing it the first time'''
+        if (binary, wide) not in self.logs:
+            fname = os.path.join(self.workDir, "pinglog-%s%s.%s" % (self.date, "-wide" if wide else "",
+                                                                     "bin" if binary else "csv"))
+            (nhosts, interval) = (self.nhosts, site_config.measure_interval)
+            if wide:
+                (nhosts, interval) = (nhosts * self.WIDE, interval * self.WIDE)
+            synthlog.writeLog(fname, nhosts, self.date, binary=binary, interval=interval)
+            self.logs[(binary, wide)] = fname
+        return self.logs[(binary, wide)]
+
+    def getSeries(self):
+        ingest = pinggraph.LogIngest()
+        ingest.update(self.getLog())
+        return ingest.allTargets.values()[0]
+
+# Each benchmark takes a Context, does any setup, and returns
+# (function to time, number of operations it does per call)
+
+def benchChecksum(ctx):
+    packet = "\x08\x00\x00\x00\x12\x34\x00\x01" + "\x55" * 56
+    def run():
+        for i in xrange(10000):
+            ping.EchoRequest.getChecksum(packet)
+    return (run, 10000)
+
+def benchPacket(ctx):
+    def run():
+        for i in xrange(10000):
+            ping.EchoRequest("10.0.0.1", 0x1234, i, "\x55" * 56)
+    return (run, 10000)
+
+def benchPingReplies(ctx):
+    hosts = ping.packAddresses([ ip for (ip, mac) in synthlog.makeHosts(1000) ])
+    pinger = ping.Pinger(timeout=1.0, sock=EchoSocket())
+    def run():
+        assert pinger.ping(hosts).countReplies() == len(hosts)
+    return (run, len(hosts))
+
+def benchIngestCsv(ctx):
+    fname = ctx.getLog()
+    nrecs = ctx.nhosts * (24*3600 // site_config.measure_interval)
+    def run():
+        pinggraph.getDataSeries(fname, {})
+    return (run, nrecs)
+
+def benchIngestBinary(ctx):
+    fname = ctx.getLog(binary=True)
+    nrecs = os.path.getsize(fname) // pinglog.RECORD.size
+    def run():
+        pinggraph.BinaryLogIngest().update(fname)
+    return (run, nrecs)
+
+def benchIngestBinaryWide(ctx):
+    # The same number of records as ingest_binary, over WIDE times the
+    # devices, so that comparing the two shows how the cost grows with
+    # the number of devices
+    fname = ctx.getLog(binary=True, wide=True)
+    nrecs = os.path.getsize(fname) // pinglog.RECORD.size
+    def run():
+        pinggraph.BinaryLogIngest().update(fname)
+    return (run, nrecs)
+
+def benchAddPoint(ctx):
+    times = [ "%02d%02d%02d" % (i // 120, (i // 2) % 60, (i % 2) * 30) for i in range(2880) ]
+    def run():
+        series = TimeSeries()
+        for timestr in times:
+            series.addPoint(timestr, "12.5")
+    return (run, len(times))
+
+def benchWriteGraph(ctx):
+    series = ctx.getSeries()
+    fname = os.path.join(ctx.workDir, "graph.png")
+    def run():
+        pinggraph.writeGraph("10.0.0.1/02:00:0a:00:00:01", series, fname)
+    return (run, 1)
+
+def benchPngEncode(ctx):
+    series = ctx.getSeries()
+    graph = mkgraph.TimeGraph( yAxis=mkgraph.LogYAxis(**pinggraph.graphYAxis) )
+    ( pinggraph.setupGraph(graph, "encode")
+           .drawAxes()
+           .plotRangeAsBand(series, mkgraph.StdColors.band)
+           .plotSeriesAsBars(series, mkgraph.StdColors.data1)
+    )
+    def run():
+        graph.img.save(StringIO.StringIO(), "PNG")
+    return (run, 1)
+
+def benchAtlasEncode(ctx):
+    series = ctx.getSeries()
+    graph = pinggraph.drawGraph("encode", series)
+    atlas = mkgraph.GraphAtlas(pinggraph.graphSize, pinggraph.atlasPalette)
+    def run():
+        atlas.setGraph(0, mkgraph.imageToBytes(graph.getPaletteImage(pinggraph.atlasPalette)))
+    return (run, 1)
+
+def benchSvgGraph(ctx):
+    series = ctx.getSeries()
+    def run():
+        pinggraph.drawGraph("10.0.0.1/02:00:0a:00:00:01", series, svg=True).getSvgData()
+    return (run, 1)
+
+def benchHtmlPage(ctx):
+    hosts = synthlog.makeHosts(ctx.nhosts)
+    outlist = [ (ip + "/" + mac, "ping-%05d.png" % i) for (i, (ip, mac)) in enumerate(hosts) ]
+    lastSeen = dict([ (mac, time.localtime()) for (ip, mac) in hosts ])
+    fname = os.path.join(ctx.workDir, "page.html")
+    def run():
+        pinggraph.writeHtmlPage(fname, outlist, lastSeen)
+    return (run, 1)
+
+benchmarks = [
+    ("checksum",       benchChecksum),
+    ("packet",         benchPacket),
+    ("ping_replies",   benchPingReplies),
+    ("ingest_csv",     benchIngestCsv),
+    ("ingest_binary",  benchIngestBinary),
+    ("ingest_wide",    benchIngestBinaryWide),
+    ("addpoint",       benchAddPoint),
+    ("write_graph",    benchWriteGraph),
+    ("png_encode",     benchPngEncode),
+    ("atlas_encode",   benchAtlasEncode),
+    ("svg_graph",      benchSvgGraph),
+    ("html_page",      benchHtmlPage),
+]
+
+#------------------------------------------------------------------------------
+
+def timeBenchmark(setup, ctx, repeat):
+    '''Returns a dict of the results of one benchmark'''
+    with Quiet():
+        (func, ops) = setup(ctx)
+        func() # Warm up caches
+        times = []
+        for i in range(repeat):
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+    times.sort()
+    return { 'ops': ops,
+             'best': times[0],
+             'median': times[len(times)//2],
+             'perOp': times[0] / ops,
+             'opsPerSec': ops / times[0] }
+
+def getRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(names, nhosts, repeat):
+    workDir = tempfile.mkdtemp(prefix="netmon-bench-")
+    try:
+        ctx = Context(nhosts, workDir)
+        results = {}
+        for (name, setup) in benchmarks:
+            if len(names) > 0 and name not in names:
+                continue
+            results[name] = timeBenchmark(setup, ctx, repeat)
+            print "%-16s %12.1f ops/s %10.3f ms/op" % (name, results[name]['opsPerSec'], results[name]['perOp']*1000.0)
+    finally:
+        shutil.rmtree(workDir)
+    return { 'revision': getRevision(),
+             'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+             'python': platform.python_version(),
+             'numpy': mkgraph.numpy != None,
+             'hosts': nhosts,
+             'repeat': repeat,
+             'results': results }
+
+def compareResults(old, new):
+    print "\nCompared with", old.get('revision'), "of", old.get('time')
+    for name in sorted(new['results'].keys()):
+        if name in old['results']:
+            ratio = old['results'][name]['perOp'] / new['results'][name]['perOp']
+            print "%-16s %6.2fx %s" % (name, ratio, "faster" if ratio >= 1.0 else "slower")
+
+def usage():
+    print "Usage:", sys.argv[0], "[-o <out.json>] [-c <previous.json>] [-n <hosts>] [-r <repeat>] [-f <font>] [<benchmark> ...]"
+    print "Benchmarks are:", ", ".join([ name for (name, setup) in benchmarks ])
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        (opts, names) = getopt.getopt(sys.argv[1:], "o:c:n:r:f:h")
+    except getopt.GetoptError:
+        usage()
+    (outfile, compareFile, nhosts, repeat) = (None, None, 20, 5)
+    for (opt, val) in opts:
+        if opt == "-o":
+            outfile = val
+        elif opt == "-c":
+            compareFile = val
+        elif opt == "-n":
+            nhosts = int(val)
+        elif opt == "-r":
+            repeat = int(val)
+        elif opt == "-f":
+            site_config.graph_font = val
+        else:
+            usage()
+    for name in names:
+        if name not in dict(benchmarks):
+            usage()
+    if not hasattr(site_config, "page_title"):
+        site_config.page_title = "Benchmark"
+
+    report = runBenchmarks(names, nhosts, repeat)
+    if outfile != None:
+        with open(outfile, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print "Wrote", outfile
+    if compareFile != None:
+        with open(compareFile, "r") as f:
+            compareResults(json.load(f), report)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+# A simulated network for load-testing ping.py without root: a range of
+# hosts, some of which are up, answering pings after a random delay,
+# sometimes losing them, sometimes answering twice, plus stray replies
+# meant for someone else. SimSocket stands in for ping.IcmpSocket, and
+# SimARP for ping.ARP.
+#
+# Run from the top of the source tree, e.g.:
+#   python -m bench.simnet -n 65536 -l 0.1 -r 20000
+# to sweep a /16 with 10% of it up, or with -c 2 to run doPing()
+# end-to-end for two measurement cycles. Replies arrive in real time, so
+# the sweep takes as long as it would on a real network.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import sys
+import os
+import time
+import json
+import array
+import errno
+import fcntl
+import getopt
+import heapq
+import random
+import select
+import shutil
+import struct
+import resource
+import tempfile
+import threading
+import collections
+import itertools
+
+import site_config
+import ping
+import pinglog
+from ping import monotonic
+
+from bench import Quiet
+from bench.fakesocket import makeReply
+
+class SimNetwork:
+    '''nhosts consecutive addresses from firstIp. A fraction 'live' of
+       them are up, each with its own typical round-trip time (rttMs on
+       average); each reply takes a lognormally-distributed time around
+       that. Each ping is lost with probability 'loss', and answered twice
+       with probability 'duplicates'. With probability 'strays', each ping
+       sent also brings in a reply for another process from a random
+       address.'''
+    def __init__(self, firstIp="10.0.0.0", nhosts=65536, live=0.1, rttMs=5.0, rttSigma=0.3,
+                 loss=0.01, duplicates=0.001, strays=0.001, seed=1):
+        self.firstIp = pinglog.packIp(firstIp)
+        self.nhosts = nhosts
+        self.rttSigma = rttSigma
+        self.loss = loss
+        self.duplicates = duplicates
+        self.strays = strays
+        self.rand = random.Random(seed)
+        # Typical RTT of each host in seconds, 0 if it is down
+        self.rtts = array.array('f', [ self.rand.expovariate(1000.0/rttMs) if self.rand.random() < live else 0.0
+                                       for i in xrange(nhosts) ])
+        self.lost = set()    # (addr, sequence) of pings lost
+        self.seen = set()    # Addresses which have answered, so are in the ARP table
+        self.sentRtt = {}    # (addr, sequence) -> RTT of its (first) reply
+
+    def getIndex(self, addr):
+        i = pinglog.packIp(addr) - self.firstIp
+        if 0 <= i < self.nhosts:
+            return i
+        return None
+
+    def isLive(self, addr):
+        i = self.getIndex(addr)
+        return i != None and self.rtts[i] > 0.0
+
+    def getMac(self, addr):
+        '''The MAC address of addr, made up from its index'''
+        i = self.getIndex(addr)
+        return "02:00:" + ":".join([ "%02x" % ((i >> shift) & 0xFF) for shift in (24, 16, 8, 0) ])
+
+    def getAddresses(self):
+        '''Returns the network's addresses, packed, as ping.Pinger.sweep() takes them'''
+        return array.array('I', xrange(self.firstIp, self.firstIp + self.nhosts))
+
+    def respond(self, packet, addr):
+        '''Returns a list of (delay, reply, fromAddr) for an ECHO_REQUEST
+           sent to addr'''
+        replies = []
+        sequence = struct.unpack_from("!H", packet, 6) [0]
+        if self.rand.random() < self.strays:
+            other = pinglog.unpackIp(self.firstIp + self.rand.randrange(self.nhosts))
+            replies.append( (self.rand.uniform(0.0, 0.01), makeReply(packet, other, self.rand.randrange(0x10000)), other) )
+        i = self.getIndex(addr)
+        if i == None or self.rtts[i] == 0.0:
+            return replies
+        if self.rand.random() < self.loss:
+            self.lost.add( (addr, sequence) )
+            return replies
+        rtt = self.rtts[i] * self.rand.lognormvariate(0.0, self.rttSigma)
+        self.sentRtt[ (addr, sequence) ] = rtt
+        self.seen.add(addr)
+        reply = makeReply(packet, addr)
+        replies.append( (rtt, reply, addr) )
+        if self.rand.random() < self.duplicates:
+            replies.append( (rtt + self.rand.uniform(0.0, 0.01), reply, addr) )
+        return replies
+
+class SimSocket:
+    '''Stands in for ping.IcmpSocket on a SimNetwork. Replies are held
+       until they are due, when a thread moves them to a queue and makes
+       the socket readable (through a pipe, so select() works). The kernel
+       timestamp reported with each reply is the time it was due, as a
+       real socket's would be.'''
+    def __init__(self, network):
+        self.network = network
+        self.lock = threading.Lock()
+        self.pending = []                 # Heap of (due, n, reply, fromAddr)
+        self.ready = collections.deque()  # (reply, fromAddr, stamp)
+        self.count = 0
+        (self.rfd, self.wfd) = os.pipe()
+        (self.wakeR, self.wakeW) = os.pipe()
+        for fd in (self.rfd, self.wakeR):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.closed = False
+        self.sent = 0
+        self.delivered = 0
+        self.thread = threading.Thread(target=self._deliver)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.closed = True
+        os.write(self.wakeW, "x")
+        self.thread.join()
+        for fd in (self.rfd, self.wfd, self.wakeR, self.wakeW):
+            os.close(fd)
+
+    def fileno(self):
+        return self.rfd
+
+    def sendto(self, packet, addr):
+        now = monotonic()
+        with self.lock:
+            self.sent += 1
+            wake = False
+            for (delay, reply, fromAddr) in self.network.respond(packet, addr[0]):
+                self.count += 1
+                due = now + delay
+                wake = wake or len(self.pending) == 0 or due < self.pending[0][0]
+                heapq.heappush(self.pending, (due, self.count, reply, fromAddr))
+        if wake:
+            os.write(self.wakeW, "x")
+        return len(packet)
+
+    def receive(self, buf):
+        with self.lock:
+            if len(self.ready) == 0:
+                return None
+            (reply, fromAddr, stamp) = self.ready.popleft()
+            if len(self.ready) == 0:
+                os.read(self.rfd, 1)
+        buf[:len(reply)] = reply
+        return (len(reply), (fromAddr, 0), stamp)
+
+    def _deliver(self):
+        timeout = None
+        while not self.closed:
+            select.select([self.wakeR], [], [], timeout)
+            try:
+                os.read(self.wakeR, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            with self.lock:
+                now = monotonic()
+                wallOffset = time.time() - now
+                wasEmpty = len(self.ready) == 0
+                while len(self.pending) > 0 and self.pending[0][0] <= now:
+                    (due, n, reply, fromAddr) = heapq.heappop(self.pending)
+                    self.ready.append( (reply, fromAddr, due + wallOffset) )
+                    self.delivered += 1
+                if wasEmpty and len(self.ready) > 0:
+                    os.write(self.wfd, "x")
+                if len(self.pending) > 0:
+                    timeout = max(self.pending[0][0] - now, 0.0)
+                else:
+                    timeout = None
+
+class SimARP:
+    '''Stands in for ping.ARP on a SimNetwork: live hosts have a MAC
+       address, and those which have answered a ping are neighbours'''
+    def __init__(self, network):
+        self.network = network
+
+    def poll(self):
+        pass
+
+    def getMacAddress(self, ip):
+        if self.network.isLive(ip):
+            return self.network.getMac(ip)
+        return "-"
+
+    def getNeighbours(self):
+        return dict([ (ip, self.network.getMac(ip)) for ip in self.network.seen ])
+
+#------------------------------------------------------------------------------
+
+def getUsage():
+    '''Returns (CPU seconds, peak memory in kB) used so far by this process
+       and any children it has finished with'''
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    rc = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (ru.ru_utime + ru.ru_stime + rc.ru_utime + rc.ru_stime, max(ru.ru_maxrss, rc.ru_maxrss))
+
+def checkSweep(network, sweeps):
+    '''Checks the results of sweeps against what the network did'''
+    errors = collections.Counter()
+    delayErrors = []
+    for req in itertools.chain(*sweeps):
+        key = (req.destAddr, req.ID & 0xFFFF)
+        if not network.isLive(req.destAddr):
+            if req.getDelay() != None:
+                errors['dead host answered'] += 1
+        elif key in network.lost:
+            if req.getDelay() != None:
+                errors['lost ping answered'] += 1
+        elif req.getDelay() == None:
+            errors['reply missed'] += 1
+        else:
+            delayErrors.append(abs(req.getDelay() - network.sentRtt[key]))
+    delayErrors.sort()
+    return { 'errors': dict(errors),
+             'answered': len(delayErrors),
+             'delayErrorMedianMs': delayErrors[len(delayErrors)//2] * 1000.0 if delayErrors else None,
+             'delayErrorMaxMs': delayErrors[-1] * 1000.0 if delayErrors else None }
+
+def runSweep(network, rate, measures=0):
+    '''Sweeps the whole network with ping.Pinger, then pings the hosts
+       found 'measures' times more, as ping.py would, and checks the
+       results'''
+    sock = SimSocket(network)
+    pinger = ping.Pinger(timeout=site_config.ping_timeout_max, sock=sock, minTimeout=site_config.ping_timeout_min)
+    (cpu0, mem0) = getUsage()
+    start = monotonic()
+    with Quiet():
+        results = pinger.sweep(network.getAddresses(), rate)
+    elapsed = monotonic() - start
+    (cpu1, mem1) = getUsage()
+    report = { 'probes': len(results),
+               'sweepSeconds': elapsed,
+               'cpuPerProbeUs': (cpu1 - cpu0) / len(results) * 1e6,
+               'peakMemoryKb': mem1,
+               'measureSeconds': [] }
+    found = results.getReplied()
+    sweeps = [ results ]
+    for i in range(measures):
+        start = monotonic()
+        with Quiet():
+            sweeps.append(pinger.ping(found))
+        report['measureSeconds'].append(monotonic() - start)
+    sock.close()
+    report.update(checkSweep(network, sweeps))
+    return report
+
+def checkLog(network, logFile):
+    '''Checks the records ping.py logged against the network'''
+    errors = collections.Counter()
+    (rows, lost) = (0, 0)
+    with open(logFile, "r") as f:
+        for line in f:
+            (timestr, ip, mac, delay) = line.rstrip().split(",")
+            rows += 1
+            if not network.isLive(ip):
+                errors['dead host logged'] += 1
+            elif mac != network.getMac(ip):
+                errors['wrong MAC'] += 1
+            if delay == "-":
+                lost += 1
+    return { 'rows': rows, 'lostRows': lost, 'errors': dict(errors) }
+
+def runDoPing(network, rate, cycles, shards=1):
+    '''Runs ping.doPing() end-to-end on the network, with its log in a
+       temporary directory, and checks what it logged. With more than one
+       shard, each has its own copy of the network, so hosts only become
+       neighbours (see SimARP) in the shard which pinged them.'''
+    workDir = tempfile.mkdtemp(prefix="netmon-sim-")
+    saved = dict([ (name, getattr(site_config, name)) for name in
+                   ("first_ip", "last_ip", "extra_ips", "sweep_rate", "measure_interval", "log_format", "input_file",
+                    "ping_shards") ])
+    try:
+        site_config.first_ip = pinglog.unpackIp(network.firstIp)
+        site_config.last_ip = pinglog.unpackIp(network.firstIp + network.nhosts - 1)
+        site_config.extra_ips = []
+        site_config.sweep_rate = rate
+        site_config.measure_interval = 1
+        site_config.log_format = "csv"
+        site_config.input_file = os.path.join(workDir, "pinglog-%(date)s.csv")
+        site_config.ping_shards = shards
+        sock = SimSocket(network)
+        sent0 = ping.stats.get("ping_probes_sent_total")
+        (cpu0, mem0) = getUsage()
+        start = monotonic()
+        with Quiet():
+            ping.doPing([], sock=sock, arp=SimARP(network), cycles=cycles,
+                        sockFactory=lambda: SimSocket(network))
+        elapsed = monotonic() - start
+        (cpu1, mem1) = getUsage()
+        sock.close()
+        probes = ping.stats.get("ping_probes_sent_total") - sent0
+        report = { 'cycles': cycles,
+                   'shards': shards,
+                   'seconds': elapsed,
+                   'probes': probes,
+                   'cpuPerProbeUs': (cpu1 - cpu0) / probes * 1e6,
+                   'peakMemoryKb': mem1,
+                   'rows': 0, 'lostRows': 0, 'errors': {} }
+        for fname in os.listdir(workDir):
+            result = checkLog(network, os.path.join(workDir, fname))
+            report['rows'] += result['rows']
+            report['lostRows'] += result['lostRows']
+            for (what, count) in result['errors'].iteritems():
+                report['errors'][what] = report['errors'].get(what, 0) + count
+        return report
+    finally:
+        for (name, value) in saved.iteritems():
+            setattr(site_config, name, value)
+        shutil.rmtree(workDir)
+
+def usage():
+    print "Usage:", sys.argv[0], "[-n <hosts>] [-l <live fraction>] [-r <sweep rate>] [-c <doPing cycles> [-s <shards>]] [-o <out.json>]"
+    print "       ", sys.argv[0], "[-n <hosts>] [-l <live fraction>] [-r <sweep rate>] [-m <measurements>] [-o <out.json>]"
+    print "Without -c, sweeps the network once with ping.Pinger, then pings the hosts"
+    print "found as many times as -m says"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "n:l:r:c:m:s:o:h")
+    except getopt.GetoptError:
+        usage()
+    if len(args) > 0:
+        usage()
+    (nhosts, live, rate, cycles, measures, shards, outfile) = (65536, 0.1, 20000, None, 0, 1, None)
+    for (opt, val) in opts:
+        if opt == "-n":
+            nhosts = int(val)
+        elif opt == "-l":
+            live = float(val)
+        elif opt == "-r":
+            rate = int(val)
+        elif opt == "-c":
+            cycles = int(val)
+        elif opt == "-m":
+            measures = int(val)
+        elif opt == "-s":
+            shards = int(val)
+        elif opt == "-o":
+            outfile = val
+        else:
+            usage()
+
+    network = SimNetwork(nhosts=nhosts, live=live)
+    if cycles == None:
+        report = runSweep(network, rate, measures)
+    else:
+        report = runDoPing(network, rate, cycles, shards)
+    report.update( { 'hosts': nhosts, 'live': live, 'rate': rate } )
+    for key in sorted(report.keys()):
+        print "%-20s %s" % (key, report[key])
+    if outfile != None:
+        with open(outfile, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print "Wrote", outfile
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Generates a day's log for made-up hosts, as ping.py would write it, so
+# that pinggraph.py can be tried out and timed without a network.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import sys
+import time
+import random
+
+import site_config
+import pinglog
+
+def makeHosts(nhosts, firstIp="10.0.0.1"):
+    '''Returns a list of (ip, mac) for nhosts consecutive addresses'''
+    base = pinglog.packIp(firstIp)
+    hosts = []
+    for i in range(nhosts):
+        addr = base + i
+        mac = "02:00:" + ":".join([ "%02x" % ((addr >> shift) & 0xFF) for shift in (24, 16, 8, 0) ])
+        hosts.append( (pinglog.unpackIp(addr), mac) )
+    return hosts
+
+def generateRecords(hosts, date, interval=None, lossRate=0.01, seed=1):
+    '''Yields (timestamp, ip, mac, delayMs) for each of hosts being pinged
+       every 'interval' seconds through the day 'date' (as YYYYMMDD), in
+       time order. Each host has its own typical round-trip time, with
+       an occasional slow reply; delayMs is None for a lost ping.'''
+    if interval == None:
+        interval = site_config.measure_interval
+    rand = random.Random(seed)
+    baseDelays = [ rand.uniform(0.5, 50.0) for host in hosts ]
+    midnight = time.mktime(time.strptime(date, "%Y%m%d"))
+    spacing = float(interval) / max(len(hosts), 1)
+    for n in xrange(int(24*3600 // interval)):
+        for i in range(len(hosts)):
+            (ip, mac) = hosts[i]
+            timestamp = midnight + n*interval + i*spacing
+            if rand.random() < lossRate:
+                delayMs = None
+            else:
+                delayMs = baseDelays[i] * rand.lognormvariate(0.0, 0.3)
+                if rand.random() < 0.02:
+                    delayMs *= 20.0
+            yield (timestamp, ip, mac, delayMs)
+
+def writeLog(filename, nhosts, date, binary=False, **kwargs):
+    '''Writes a log for nhosts hosts (see generateRecords), as .csv or in
+       pinglog's binary format. Returns the number of records.'''
+    nrecs = 0
+    with open(filename, "wb") as f:
+        for (timestamp, ip, mac, delayMs) in generateRecords(makeHosts(nhosts), date, **kwargs):
+            if binary:
+                f.write(pinglog.packRecord(timestamp, ip, mac, delayMs))
+            else:
+                f.write(pinglog.formatCsv(timestamp, ip, mac, delayMs) + "\n")
+            nrecs += 1
+    return nrecs
+
+def usage():
+    print "Usage:", sys.argv[0], "<nhosts> <out.csv|out.bin> [<YYYYMMDD>]"
+    print "The date defaults to today"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) not in (2, 3):
+        usage()
+    (nhosts, outfile) = (int(args[0]), args[1])
+    date = (args[2:3] or [time.strftime("%Y%m%d")]) [0]
+    nrecs = writeLog(outfile, nhosts, date, binary=outfile.endswith(".bin"))
+    print "Wrote", nrecs, "records to", outfile
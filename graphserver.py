@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# HTTP server for pinggraph.py --serve. Instead of drawing every graph
+# after each measurement, it reads the log as it grows and draws a graph
+# only when a browser asks for it. The last few hundred graphs drawn are
+# kept in memory, and each is sent with an ETag so browsers can check
+# cheaply whether it has changed.
+#
+# The page is at / (or /<page_name>); add ?hours=N to see the last N
+# hours, or ?start=T&end=T (seconds since the epoch) for any range,
+# drawn from the rollups.
+
+# This code is placed in the public domain by its author, Ian Harvey.
+# It comes with NO WARRANTY
+
+import os
+import re
+import time
+import math
+import hashlib
+import urlparse
+import collections
+import BaseHTTPServer
+import email.utils
+import site_config
+import pinglog
+import metrics
+import pinggraph
+from pinggraph import stats
+
+stats.define("pinggraph_cache_hits_total", "counter", "Graph requests answered from the cache")
+stats.define("pinggraph_cache_misses_total", "counter", "Graph requests which had to be drawn")
+stats.define("pinggraph_not_modified_total", "counter", "Graph requests answered with 304 Not Modified")
+
+class RenderCache:
+    '''The most recently used 'size' entries, by key'''
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+class GraphServer:
+    '''Keeps up with the log as pinggraph.py's main loop does, and draws
+       graphs on request. Each graph is identified by a key which
+       changes whenever what it shows does.'''
+    minRefresh = 1.0 # Seconds between looks at the log
+
+    def __init__(self, rollups, historyKinds):
+        self.rollups = rollups
+        self.historyKinds = historyKinds
+        self.ingest = pinggraph.makeIngest(rollups)
+        self.lastSeenStore = pinggraph.openLastSeen()
+        self.cache = RenderCache(site_config.graph_cache_size)
+        self.targets = []
+        self.targetsKey = None
+        self.lastRefresh = 0
+        # Keys are only unique within one run of the server
+        self.started = time.time()
+
+    def refresh(self):
+        '''Reads anything added to the log since the last call'''
+        now = time.time()
+        if now - self.lastRefresh < self.minRefresh:
+            return
+        self.lastRefresh = now
+        date = time.strftime("%Y%m%d")
+        inputFile = pinglog.logFileName(date)
+        if not os.path.isfile(inputFile):
+            return
+        with stats.timer("pinggraph_ingest_seconds") as t:
+            nlines = self.ingest.update(inputFile, date)
+        pinggraph.recordIngest(nlines, t.elapsed)
+        self.lastSeenStore.update(self.ingest.popSeen())
+        targetsKey = (self.ingest.inputFile, len(self.ingest.allTargets))
+        if targetsKey != self.targetsKey:
+            self.targets = sorted(self.ingest.allTargets.keys(), pinggraph.cmpByIp)
+            self.targetsKey = targetsKey
+        metricsFile = metrics.getFileName("pinggraph")
+        if metricsFile != None:
+            stats.writeTextfile(metricsFile)
+
+    def getPage(self, timeRange=None):
+        outlist = [ (target, pinggraph.getGraphFileName(idx)) for (idx, target) in enumerate(self.targets) ]
+        historyKinds = self.historyKinds
+        if timeRange != None:
+            outlist = [ (target, fname + "?start=%d&end=%d" % timeRange) for (target, fname) in outlist ]
+            historyKinds = []
+        return pinggraph.getHtmlPage(outlist, self.lastSeenStore.getLastSeen(), historyKinds,
+                                     pinggraph.getMetricsFooter())
+
+    def getGraph(self, idx, kind=None, timeRange=None):
+        '''Returns (key, function to draw it) for a graph of the idx'th
+           target, or None if there is no such graph'''
+        if idx >= len(self.targets):
+            return None
+        target = self.targets[idx]
+        if timeRange != None or kind != None:
+            if self.rollups == None:
+                return None
+            lastUpdate = self.rollups.getLastUpdate(target)
+        if timeRange != None:
+            (startTime, endTime) = timeRange
+            graph = pinggraph.makeRangeGraph(startTime, endTime)
+            pixel = (endTime - startTime) / float(graph.xTotal)
+            key = ("range", target, startTime, endTime, int(min(lastUpdate, endTime) // pixel),
+                   pinggraph.getRenderConfig())
+            return (key, lambda: pinggraph.drawRollupGraph(target, graph, self.rollups,
+                                                           time.strftime("from %d/%m/%Y %H:%M", time.localtime(startTime))))
+        if kind != None:
+            if kind not in pinggraph.historyGraphs:
+                return None
+            endTime = pinggraph.localMidnight(time.time()) + 24*3600
+            key = (kind,) + pinggraph.getHistoryDrawn(target, kind, self.rollups, endTime)
+            return (key, lambda: pinggraph.drawRollupGraph(target, pinggraph.makeHistoryGraph(kind, endTime),
+                                                           self.rollups, "past " + kind))
+        series = self.ingest.allTargets[target]
+        key = ("day", target, series.generation, pinggraph.getRenderConfig())
+        return (key, lambda: pinggraph.drawGraph(target, series))
+
+    def getETag(self, key):
+        return '"%s"' % hashlib.md5(repr((self.started, key))).hexdigest()
+
+    def render(self, key, draw):
+        '''Returns (PNG data, time drawn) for the graph with key, drawing
+           it if it is not in the cache'''
+        entry = self.cache.get(key)
+        if entry is not None:
+            stats.inc("pinggraph_cache_hits_total")
+            return entry
+        stats.inc("pinggraph_cache_misses_total")
+        start = time.time()
+        graph = draw()
+        drawn = time.time()
+        entry = (graph.getPngData(), drawn)
+        pinggraph.recordGraphTimings([ (drawn - start, time.time() - drawn) ])
+        self.cache.put(key, entry)
+        return entry
+
+def getTimeRange(query):
+    '''Returns (start, end) from a request's query, or None for today's
+       graphs; raises ValueError if it makes no sense. Ranges ending now
+       are rounded up to a whole pixel, so that reloading the page finds
+       the same graphs in the cache until there is more to show.'''
+    minSpan = 600
+    if "start" in query:
+        startTime = int(query["start"][0])
+        endTime = int(query.get("end", [ time.time() ])[0])
+    elif "hours" in query:
+        span = int(float(query["hours"][0]) * 3600)
+        if span < minSpan:
+            raise ValueError("Time range too short")
+        pixel = span / float(pinggraph.makeRangeGraph(0, span).xTotal)
+        endTime = int(math.ceil(time.time() / pixel) * pixel)
+        startTime = endTime - span
+    else:
+        return None
+    if endTime - startTime < minSpan:
+        raise ValueError("Time range too short")
+    return (startTime, endTime)
+
+class GraphRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    graphPath = re.compile(r"^/ping-(\d+)(?:-([a-z]+))?\.png$")
+
+    def do_GET(self):
+        graphs = self.server.graphs
+        url = urlparse.urlparse(self.path)
+        try:
+            timeRange = getTimeRange(urlparse.parse_qs(url.query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        graphs.refresh()
+        if url.path in ("/", "/" + site_config.page_name):
+            self.sendData(graphs.getPage(timeRange), "text/html")
+            return
+        m = self.graphPath.match(url.path)
+        found = None
+        if m != None:
+            found = graphs.getGraph(int(m.group(1)), m.group(2), timeRange)
+        if found == None:
+            self.send_error(404)
+            return
+        (key, draw) = found
+        etag = graphs.getETag(key)
+        if self.isNotModified(etag, graphs.cache.get(key)):
+            stats.inc("pinggraph_not_modified_total")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        (data, modified) = graphs.render(key, draw)
+        self.sendData(data, "image/png", { "ETag": etag,
+                                           "Last-Modified": email.utils.formatdate(modified, usegmt=True),
+                                           "Cache-Control": "no-cache" })
+
+    def isNotModified(self, etag, entry):
+        if "If-None-Match" in self.headers:
+            return etag in self.headers["If-None-Match"]
+        since = email.utils.parsedate_tz(self.headers.get("If-Modified-Since", ""))
+        return since != None and entry != None and email.utils.mktime_tz(since) >= int(entry[1])
+
+    def sendData(self, data, contentType, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        for (name, value) in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(port, rollups, historyKinds):
+    '''Serves the page and graphs until killed. Requests are handled one
+       at a time; between them, the log is read every graph_interval
+       seconds so that the rollups and last-seen times stay up to date
+       when nobody is looking.'''
+    httpd = BaseHTTPServer.HTTPServer((site_config.serve_address, port), GraphRequestHandler)
+    httpd.graphs = GraphServer(rollups, historyKinds)
+    httpd.timeout = site_config.graph_interval
+    print "Serving on port", port
+    while True:
+        httpd.handle_request()
+        httpd.graphs.refresh()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Record of when each device was first and last seen, kept by
+# pinggraph.py in an SQLite database. Each update is one transaction in
+# write-ahead-log mode, so a crash leaves either the old record or the
+# new one, and the page can be drawn from it while it is being updated.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import os
+import time
+import pickle
+import sqlite3
+
+class LastSeenStore:
+    '''One row per device, keyed by MAC address and name (either of which
+       may be unknown, as "-" and "" respectively)'''
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS devices (
+                    mac TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    first_seen REAL NOT NULL,
+                    last_seen REAL NOT NULL,
+                    last_ip TEXT NOT NULL,
+                    PRIMARY KEY (mac, name) );
+                CREATE INDEX IF NOT EXISTS devices_by_name ON devices (name, last_seen);'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        isNew = not os.path.exists(filename)
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+        self.isNew = isNew
+
+    def close(self):
+        self.db.close()
+
+    def update(self, seen):
+        '''seen is a dictionary of (mac, name) -> (first, last, ip): the
+           times each device was first and last seen since the last
+           update, and its IP address when last seen'''
+        rows = [ (mac, name, first, last, ip) for ((mac, name), (first, last, ip)) in seen.iteritems() ]
+        with self.db:
+            self.db.executemany('''INSERT OR IGNORE INTO devices (mac, name, first_seen, last_seen, last_ip)
+                                   VALUES (?1, ?2, ?3, ?4, ?5)''', rows)
+            self.db.executemany('''UPDATE devices SET first_seen = MIN(first_seen, ?3),
+                                       last_seen = MAX(last_seen, ?4),
+                                       last_ip = CASE WHEN ?4 >= last_seen THEN ?5 ELSE last_ip END
+                                   WHERE mac = ?1 AND name = ?2''', rows)
+
+    def getLastSeen(self):
+        '''Returns a dictionary of name -> time (as a struct_time) when a
+           device of that name was last seen, for named devices'''
+        cursor = self.db.execute('''SELECT name, MAX(last_seen) FROM devices
+                                    WHERE name != '' GROUP BY name''')
+        return dict([ (name, time.localtime(timestamp)) for (name, timestamp) in cursor ])
+
+    def getDevice(self, mac, name=""):
+        '''Returns (first seen, last seen, last IP) for a device, or None'''
+        return self.db.execute('''SELECT first_seen, last_seen, last_ip FROM devices
+                                  WHERE mac = ? AND name = ?''', (mac, name)).fetchone()
+
+    def importPickle(self, filename):
+        '''Adds the names and times from an old-style pickled last-seen
+           file, which has no MAC or IP addresses'''
+        with open(filename, "r") as f:
+            lastSeen = pickle.load(f)
+        self.update(dict([ (("-", name), (time.mktime(t), time.mktime(t), "-")) for (name, t) in lastSeen.iteritems() ]))
+        return len(lastSeen)
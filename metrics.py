@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Counters and timings kept by ping.py and pinggraph.py, written out as
+# Prometheus text-format files (for node_exporter's textfile collector,
+# say) and read back to show on the results page.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import os
+import time
+import site_config
+
+class Metrics:
+    '''A set of named values. Names may carry Prometheus labels, e.g.
+       'ping_sweep_seconds{kind="measure"}'. Counters only go up; gauges
+       are set. Updating one is a dictionary operation, but in hot loops
+       it is better to count in a local variable and add the total.'''
+    def __init__(self):
+        self.kinds = {}   # Base name -> (type, help)
+        self.values = {}  # Name, with labels -> value
+
+    def define(self, name, kind, helpText):
+        '''Declares a metric; kind is "counter" or "gauge"'''
+        self.kinds[name] = (kind, helpText)
+        if kind == "counter" and name not in self.values:
+            self.values[name] = 0
+
+    def inc(self, name, amount=1):
+        self.values[name] = self.values.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def timer(self, name):
+        '''Returns a context manager which sets gauge 'name' to the number
+           of seconds taken by the code it runs'''
+        return Timer(self, name)
+
+    def format(self):
+        '''Returns the metrics in the Prometheus text format'''
+        lines = []
+        described = set()
+        for name in sorted(self.values.keys()):
+            base = name.split("{")[0]
+            if base not in described and base in self.kinds:
+                (kind, helpText) = self.kinds[base]
+                lines += [ "# HELP %s %s" % (base, helpText), "# TYPE %s %s" % (base, kind) ]
+                described.add(base)
+            lines.append("%s %s" % (name, repr(float(self.values[name]))))
+        return "\n".join(lines) + "\n"
+
+    def writeTextfile(self, filename):
+        '''Writes the metrics to filename, replacing it in one go so that
+           readers never see part of a file'''
+        tempname = "%s.tmp%d" % (filename, os.getpid())
+        with open(tempname, "w") as f:
+            f.write(self.format())
+        os.rename(tempname, filename)
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        self.metrics.set(self.name, self.elapsed)
+
+def readTextfile(filename):
+    '''Returns the values in a Prometheus text-format file as a dictionary,
+       or an empty one if the file can't be read'''
+    values = {}
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                if line.startswith("#") or line.strip() == "":
+                    continue
+                (name, value) = line.rsplit(None, 1)
+                values[name] = float(value)
+    except (IOError, ValueError):
+        pass
+    return values
+
+def getFileName(program):
+    '''Where program's metrics go, or None if they are not to be written'''
+    if site_config.metrics_path == None:
+        return None
+    return os.path.join(site_config.metrics_path, program + ".prom")
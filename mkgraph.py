@@ -7,9 +7,51 @@ import glob
 import math
 import Image, ImageDraw, ImageFont
 import array
+import binascii
+import bisect
+import itertools
+import StringIO
+from xml.sax.saxutils import escape
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 modeRGB = "RGB"
 
+# Older PIL only has fromstring(); Pillow has replaced it with frombytes()
+imageFromBytes = getattr(Image, "frombytes", None) or Image.fromstring
+
+def imageToBytes(img):
+    if hasattr(img, "tobytes"):
+        return img.tobytes()
+    return img.tostring()
+
+fontCache = {}
+
+def loadTrueTypeFont(fontfile, size, encoding="unic"):
+    '''Loads a font, or returns the one loaded earlier with the same arguments'''
+    key = (fontfile, size, encoding)
+    font = fontCache.get(key)
+    if font is None:
+        font = ImageFont.truetype(fontfile, size=size, encoding=encoding)
+        fontCache[key] = font
+    return font
+
+def replaceFile(filename, writer):
+    '''Calls writer(tempname) and then renames tempname to filename, so
+       readers of filename never see a partly-written file'''
+    (root, ext) = os.path.splitext(filename)
+    tempname = "%s.tmp%d%s" % (root, os.getpid(), ext)
+    try:
+        writer(tempname)
+        os.rename(tempname, filename)
+    except:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
 class StdColors:
     background = (255, 255, 224)
 
@@ -21,6 +63,113 @@ class StdColors:
     data2 = (255, 64, 64)
     data3 = (64, 255, 64)
     title = (255, 0, 0)
+    band = (176, 176, 216)
+    percentile = (224, 128, 0)
+    loss = (255, 0, 0)
+
+def getPalette(colors):
+    '''Returns a "P" mode image whose palette holds each colour in a
+       colors class (e.g. StdColors), for Graph.getPaletteImage()'''
+    rgb = []
+    for name in sorted(dir(colors)):
+        value = getattr(colors, name)
+        if isinstance(value, tuple) and len(value) == 3 and value not in rgb:
+            rgb.append(value)
+    flat = [ c for colour in rgb for c in colour ]
+    palette = Image.new("P", (1, 1))
+    palette.putpalette(flat + flat[:3] * (256 - len(rgb)))
+    return palette
+
+def svgColor(color):
+    return "#%02x%02x%02x" % color
+
+class SvgDraw:
+    '''Stands in for an ImageDraw.Draw object (see Graph.hasSvgDrawObject),
+       recording what is drawn as SVG. Lines of the same colour drawn one
+       after another go into a single path.'''
+    def __init__(self, xSize, ySize, background, fontSize=11):
+        self.size = (xSize, ySize)
+        self.background = background
+        self.fontSize = fontSize
+        self.elements = []
+        self.pathColor = None
+        self.path = []
+
+    def _endPath(self):
+        if len(self.path) > 0:
+            self.elements.append('<path fill="none" stroke="%s" d="%s"/>' % (svgColor(self.pathColor), "".join(self.path)))
+        self.path = []
+
+    def line(self, xy, fill=None, width=0):
+        if not isinstance(xy[0], tuple):
+            xy = zip(xy[0::2], xy[1::2])
+        if fill != self.pathColor:
+            self._endPath()
+            self.pathColor = fill
+        # Pixel centres, so lines cover the same pixels as ImageDraw's
+        ((x0, y0), (x1, y1)) = (xy[0], xy[-1])
+        if len(xy) == 2 and x0 == x1:
+            self.path.append("M%g %gV%g" % (x0+0.5, y0+0.5, y1+0.5))
+        elif len(xy) == 2 and y0 == y1:
+            self.path.append("M%g %gH%g" % (x0+0.5, y0+0.5, x1+0.5))
+        else:
+            self.path.append( "M" + "L".join([ "%g %g" % (x+0.5, y+0.5) for (x,y) in xy ]) )
+
+    def text(self, xy, text, fill=None, font=None):
+        self._endPath()
+        self.elements.append('<text x="%g" y="%g" fill="%s">%s</text>' %
+                             (xy[0], xy[1] + self.fontSize - 2, svgColor(fill), escape(text)))
+
+    def getSvg(self):
+        self._endPath()
+        return "\n".join(
+            [ '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" shape-rendering="crispEdges"'
+              ' stroke-linecap="square" font-family="monospace" font-size="%d">' % (self.size + (self.fontSize,)),
+              '<rect width="100%%" height="100%%" fill="%s"/>' % svgColor(self.background) ]
+            + self.elements + [ '</svg>' ] )
+
+class GraphAtlas:
+    '''Holds many graphs of the same size as a few large palette images
+       ("sheets"), perSheet graphs stacked in each, so a page can show
+       them all with a handful of files and requests. Each graph is put
+       in place on the page with CSS; see getStyle().'''
+    def __init__(self, cellSize, palette, perSheet=32):
+        self.cellSize = cellSize
+        self.palette = palette
+        self.perSheet = perSheet
+        self.sheets = []
+        self.versions = []
+        self.changed = set()
+
+    def setGraph(self, slot, data):
+        '''Puts the graph with data (the bytes of a "P" mode image, using
+           palette) in a slot, counting from 0'''
+        (sheet, row) = divmod(slot, self.perSheet)
+        while len(self.sheets) <= sheet:
+            img = Image.new("P", (self.cellSize[0], self.cellSize[1] * self.perSheet))
+            img.putpalette(self.palette.getpalette())
+            self.sheets.append(img)
+            self.versions.append(0)
+        self.sheets[sheet].paste(imageFromBytes("P", self.cellSize, data), (0, row * self.cellSize[1]))
+        self.changed.add(sheet)
+
+    def save(self, fileNameFormat):
+        '''Writes out the sheets changed since the last call, as
+           fileNameFormat % (sheet number)'''
+        for sheet in sorted(self.changed):
+            replaceFile(fileNameFormat % sheet, self.sheets[sheet].save)
+            self.versions[sheet] += 1
+        self.changed.clear()
+        return self
+
+    def getStyle(self, slot, urlFormat):
+        '''Returns CSS to show the graph in a slot as the background of an
+           element; the sheet's URL carries a version number, so browsers
+           fetch it again when it has changed'''
+        (sheet, row) = divmod(slot, self.perSheet)
+        url = "%s?%d" % (urlFormat % sheet, self.versions[sheet])
+        return ("display:inline-block;width:%dpx;height:%dpx;background:url(%s) 0 %dpx" %
+                (self.cellSize[0], self.cellSize[1], url, -row * self.cellSize[1]))
 
 class LinearYAxis:
     def __init__(self, yUnits=1, yPixPerUnit=100):
@@ -31,6 +180,10 @@ class LinearYAxis:
     def getHeight(self):
         return self.yTotal
 
+    def getKey(self):
+        '''Returns something which is equal for axes which draw the same'''
+        return (self.__class__, self.yUnits, self.yPixPerUnit)
+
     def yLabel(self, y):
         '''This can be overridden in a subclass if needed'''
         if ((y%10)==0):
@@ -41,6 +194,11 @@ class LinearYAxis:
     def scaleY(self, value):
         return int ( self.yPixPerUnit * value )
 
+    def scaleColumn(self, values, limit):
+        '''scaleY() for a whole column of values at once, capped at limit;
+           None (or NaN) values give None'''
+        return [ None if (v is None or v != v) else min(self.scaleY(v), limit) for v in values ]
+
     def draw(self, graph):
         # Axis itself
         graph.draw.line( [ (graph.originX, graph.originY), (graph.originX, graph.originY-self.yTotal-1) ] , fill=graph.colors.axes)
@@ -60,10 +218,14 @@ class LogYAxis:
         self.decades      = int(decades)
         self.yPixPerDecade= yPixPerDecade
         self.yTotal = int(decades * yPixPerDecade + lowerMarginPix)
+        self.thresholds = None
     
     def getHeight(self):
         return self.yTotal
 
+    def getKey(self):
+        return (self.__class__, self.minVal, self.decades, self.yPixPerDecade, self.lowerMargin)
+
     def yLabel(self, y):
         return "%.1f" % y
             
@@ -73,6 +235,36 @@ class LogYAxis:
         else:
             return self.lowerMargin + int( self.yPixPerDecade * math.log10(value/self.minVal) )
 
+    def getThresholds(self, limit):
+        '''Returns a table of the values at which scaleY() steps up by one
+           pixel, from lowerMargin to at least limit'''
+        steps = limit - self.lowerMargin
+        if self.thresholds is None or len(self.thresholds) < steps:
+            table = []
+            for k in range(1, steps+1):
+                pix = self.lowerMargin + k
+                t = self.minVal * math.pow(10.0, float(k) / self.yPixPerDecade)
+                # Nudge onto the exact step despite rounding
+                while self.scaleY(t) < pix:
+                    t *= (1.0 + 1e-15)
+                while self.scaleY(t * (1.0 - 1e-15)) >= pix:
+                    t *= (1.0 - 1e-15)
+                table.append(t)
+            self.thresholds = table
+        return self.thresholds
+
+    def scaleColumn(self, values, limit):
+        '''scaleY() for a whole column of values at once, capped at limit;
+           None (or NaN) values give None. Uses a lookup table rather than
+           a log10() per value.'''
+        table = self.getThresholds(limit)
+        if numpy != None:
+            values = numpy.asarray(values, dtype=float)
+            pix = numpy.minimum(self.lowerMargin + numpy.searchsorted(table, values, side='right'), limit)
+            return [ None if missing else int(p) for (p, missing) in zip(pix, numpy.isnan(values)) ]
+        return [ None if (v is None or v != v) else min(self.lowerMargin + bisect.bisect_right(table, v), limit)
+                 for v in values ]
+
     def draw(self, graph):
         # Axis itself
         graph.draw.line( [ (graph.originX, graph.originY), (graph.originX, graph.originY-self.yTotal-1) ] , fill=graph.colors.axes)
@@ -103,6 +295,8 @@ class Graph:
             self.yAxis = LinearYAxis()
             
         self.colors = StdColors
+        self.img = None
+        self.font = None
 
     def hasOrigin(self, x, y):
         self.originX = x
@@ -122,12 +316,18 @@ class Graph:
         self.hasDrawObject(ImageDraw.Draw(self.img))
         return self
 
+    def hasSvgDrawObject(self, xSize, ySize):
+        '''Draws the graph as SVG instead of an image; see getSvgData()'''
+        self.img = None
+        self.hasDrawObject(SvgDraw(xSize, ySize, self.colors.background))
+        return self
+
     def hasColors(self, colors):
         self.colors = colors
         return self
 
     def hasTrueTypeFont(self, fontfile, size, encoding="unic"):
-        self.hasTextFont( ImageFont.truetype(fontfile, size=size, encoding=encoding) )
+        self.hasTextFont( loadTrueTypeFont(fontfile, size=size, encoding=encoding) )
         return self
         
     def hasTitle(self, title):
@@ -151,29 +351,97 @@ class Graph:
             if (i != 0) and ( i % 10 ) == 0:
                 self.draw.line( [ (x,y-1), (x, y-yTotal) ], fill = self.colors.xgrid ) 
             
+    # Images of the axes, grid and labels, keyed by getBackgroundKey()
+    backgrounds = {}
+    maxBackgrounds = 32
+
+    def getBackgroundKey(self):
+        '''Returns something which is equal for graphs whose axes look the
+           same; subclasses with extra settings affecting them must add them'''
+        return (self.__class__, self.img.mode, self.img.size, self.originX, self.originY,
+                self.xUnits, self.xPixPerUnit, self.colors, self.yAxis.getKey(), self.font)
+
     def drawAxes(self):
-        self.drawXAxis()
-        self.yAxis.draw(self)
+        '''Draws the axes. For a graph with its own image (hasStdDrawObject),
+           this must come before anything else is drawn: the result is
+           cached, and later graphs with the same layout start from a copy.'''
+        if self.img is None:
+            self.drawXAxis()
+            self.yAxis.draw(self)
+            return self
+
+        key = self.getBackgroundKey()
+        background = Graph.backgrounds.get(key)
+        if background is None:
+            self.drawXAxis()
+            self.yAxis.draw(self)
+            if len(Graph.backgrounds) >= Graph.maxBackgrounds:
+                Graph.backgrounds.clear()
+            Graph.backgrounds[key] = self.img.copy()
+        else:
+            self.img = background.copy()
+            self.hasDrawObject(ImageDraw.Draw(self.img))
         return self
         
     def drawTitle(self):
         self.draw.text( [ self.originX + 10, 5], self.title, fill = self.colors.title )
         return self
         
+    def fillColumns(self, lows, highs, color):
+        '''For each column x across the graph, fills from lows[x] to highs[x]
+           pixels above the x axis, inclusive; a None skips the column.
+           The columns are built up as a single mask, and painted into
+           the image in one go.'''
+        if self.img is None:
+            for pX in range(len(highs)):
+                if highs[pX] != None:
+                    self.draw.line( [ self.originX+pX, self.originY-lows[pX], self.originX+pX, self.originY-highs[pX] ], fill=color )
+            return self
+
+        filled = [ h for h in highs if h != None ]
+        if len(filled) == 0:
+            return self
+        # Only the rows from the tallest column down to the x axis are needed
+        top = self.originY - min(max(filled), self.originY)
+        maskHeight = self.originY + 1 - top
+        # Build each column as a row of a bilevel image: an integer with
+        # bits set for the filled pixels, most significant bit at the top,
+        # padded to a whole number of bytes
+        rowBits = (maskHeight + 7) // 8 * 8
+        hexFormat = "%%0%dx" % (rowBits // 4)
+        columns = []
+        for (low, high) in zip(lows, highs):
+            if high is None:
+                columns.append(hexFormat % 0)
+            else:
+                high = min(high, self.originY)
+                low = max(low, 0)
+                columns.append(hexFormat % ( ((1 << (high-low+1)) - 1) << (rowBits-1-(self.originY-top-low)) ))
+        # Each column has been built as a row, so transpose it
+        mask = ( imageFromBytes("1", (maskHeight, len(columns)), binascii.unhexlify("".join(columns)))
+                      .transpose(Image.ROTATE_90).transpose(Image.FLIP_TOP_BOTTOM) )
+        self.img.paste(color, (self.originX, top, self.originX+len(columns), top+maskHeight), mask)
+        return self
+
     def drawDataAsBars(self, color):
-        for (pX,pY) in self.generateData():
-            if pY != None:
+        heights = self.generateHeights(self.originY)
+        lows = []
+        for pX in range(len(heights)):
+            pY = heights[pX]
+            if pY != None and pY < 1:
+                # Doesn't go upwards: draw as it always has
                 self.draw.line( [ self.originX+pX, self.originY-1, self.originX+pX, self.originY-pY], fill=color )
-        return self
+                heights[pX] = None
+            lows.append(1)
+        return self.fillColumns(lows, heights, color)
             
 
     def drawDataAsLine(self, color):
-        yTotal = self.yAxis.getHeight()
+        heights = self.generateHeights(self.yAxis.getHeight())
         points = []
-        for (pX,pY) in self.generateData():
+        for pX in range(len(heights)):
+            pY = heights[pX]
             if pY != None:
-                if pY > yTotal:
-                    pY = yTotal
                 points.append( (self.originX+pX, self.originY-pY) )
             elif len(points) > 0:
                 self.draw.line(points, fill=color)
@@ -186,26 +454,235 @@ class Graph:
         # Should return a list of (x,y) points for the graph
         return []
 
+    def generateHeights(self, limit):
+        '''Returns the height of each column (or None), capped at limit.
+           Subclasses should override this to compute them all at once.'''
+        heights = [ None ] * self.xTotal
+        for (pX,pY) in self.generateData():
+            if pY != None:
+                pY = min(pY, limit)
+            heights[pX] = pY
+        return heights
+
     def saveToDisk(self, filename):
-        self.img.save(filename)
+        replaceFile(filename, self.img.save)
         return self
 
+    def getPngData(self):
+        '''Returns the image as the contents of a PNG file'''
+        buf = StringIO.StringIO()
+        self.img.save(buf, "PNG")
+        return buf.getvalue()
+
+    def getPaletteImage(self, palette):
+        '''Returns the image in "P" mode, with palette's colours (see
+           getPalette()). A graph drawn only in those colours, with the
+           default font, converts exactly.'''
+        return self.img.quantize(palette=palette)
+
+    def getSvgData(self):
+        '''Returns the SVG for a graph drawn after hasSvgDrawObject()'''
+        return self.draw.getSvg()
+
 
 class TimeSeries:
-    def __init__(self, countsPerHour=22.0):
+    '''Per-bucket statistics of the points in a day. Each statistic is kept
+       in a flat array with one entry per bucket (or, for the quantile
+       sketch, SKETCH_BINS entries per bucket), and all of them are updated
+       in a single pass as points are added.'''
+    # Generation numbers are unique across all series, so a new series
+    # can never be mistaken for an old one which has been replaced.
+    generations = itertools.count(1)
+
+    # The columns, with their array types and initial values
+    COLUMNS = [ ('counts',       'I', 0),     # Points received
+                ('totals',       'd', 0.0),   # Sum of their values
+                ('mins',         'f', float("inf")),
+                ('maxs',         'f', 0.0),
+                ('jitters',      'd', 0.0),   # Sum of |change from previous point|
+                ('jitterCounts', 'I', 0),
+                ('lost',         'I', 0) ]    # Points lost (e.g. pings with no reply)
+
+    # Quantile sketch: a histogram per bucket with SKETCH_BINS logarithmic
+    # bins per bucket, from SKETCH_MIN upwards for SKETCH_DECADES decades
+    SKETCH_MIN = 0.1
+    SKETCH_DECADES = 5
+    SKETCH_BINS = 32
+
+    def __init__(self, countsPerHour=22.0, hours=24):
         self.countsPerHour = countsPerHour
-        self.length = int(countsPerHour*24)
-        self.counts = array.array('I', [0]*self.length)
-        self.totals = array.array('d', [0.0]*self.length)
+        self.length = int(round(countsPerHour*hours))
+        for (name, typecode, initial) in self.COLUMNS:
+            setattr(self, name, array.array(typecode, [initial]) * self.length)
+        self.sketch = array.array('H', [0]) * (self.length*self.SKETCH_BINS)
+        self.lastDatum = None
+        self.generation = next(TimeSeries.generations)
 
-    def addPoint(self, timestr, datum):
+    def toCompact(self):
+        '''Returns the data as a tuple of strings, cheap to pickle'''
+        return ( (self.countsPerHour, self.length / self.countsPerHour, self.generation, self.lastDatum) +
+                 tuple([ getattr(self, name).tostring() for (name, typecode, initial) in self.COLUMNS ]) +
+                 (self.sketch.tostring(),) )
+
+    @staticmethod
+    def fromCompact(compact):
+        (countsPerHour, hours, generation, lastDatum) = compact[0:4]
+        series = TimeSeries(countsPerHour, hours)
+        for ((name, typecode, initial), data) in zip(TimeSeries.COLUMNS, compact[4:]):
+            setattr(series, name, array.array(typecode, data))
+        series.sketch = array.array('H', compact[-1])
+        series.lastDatum = lastDatum
+        series.generation = generation
+        return series
+
+    def timeIndex(self, timestr):
         assert(len(timestr)==6)
         timeHours = float(timestr[0:2]) + (float(timestr[2:4])/60.0) + float(timestr[4:6])/3600.0
         timeIndex = int(timeHours * self.countsPerHour)
-        if timeIndex > self.length:
+        if timeIndex >= self.length:
             raise ValueError("Illegal time string" + repr(timestr))
-        self.counts[timeIndex] += 1
-        self.totals[timeIndex] += float(datum)
+        return timeIndex
+
+    def sketchBin(self, datum):
+        if datum <= self.SKETCH_MIN:
+            return 0
+        b = int(math.log10(datum / self.SKETCH_MIN) * self.SKETCH_BINS / self.SKETCH_DECADES)
+        return min(b, self.SKETCH_BINS-1)
+
+    def addPointAt(self, timeIndex, datum):
+        '''Adds datum to bucket timeIndex; datum None means a lost point'''
+        if datum is None:
+            self.lost[timeIndex] += 1
+        else:
+            self.counts[timeIndex] += 1
+            self.totals[timeIndex] += datum
+            if datum < self.mins[timeIndex]:
+                self.mins[timeIndex] = datum
+            if datum > self.maxs[timeIndex]:
+                self.maxs[timeIndex] = datum
+            if self.lastDatum is not None:
+                self.jitters[timeIndex] += abs(datum - self.lastDatum)
+                self.jitterCounts[timeIndex] += 1
+            self.lastDatum = datum
+            self.sketch[timeIndex*self.SKETCH_BINS + self.sketchBin(datum)] += 1
+        self.generation = next(TimeSeries.generations)
+
+    def addPoint(self, timestr, datum):
+        self.addPointAt(self.timeIndex(timestr), float(datum))
+
+    def addLoss(self, timestr):
+        self.addPointAt(self.timeIndex(timestr), None)
+
+    def addColumn(self, timeIndexes, data):
+        '''Adds many points, in time order, at once. data[i] goes in bucket
+           timeIndexes[i], and is NaN for a lost point.'''
+        if numpy is None:
+            for (timeIndex, datum) in zip(timeIndexes, data):
+                if datum != datum:
+                    datum = None
+                self.addPointAt(int(timeIndex), datum)
+            return
+
+        timeIndexes = numpy.asarray(timeIndexes, dtype=int)
+        data = numpy.asarray(data, dtype=float)
+        isLost = numpy.isnan(data)
+        self._addCounts(self._column('lost'), timeIndexes[isLost])
+        idx = timeIndexes[~isLost]
+        got = data[~isLost]
+        if len(got) > 0:
+            self._addCounts(self._column('counts'), idx)
+            self._addCounts(self._column('totals'), idx, got)
+            # Points in time order come in runs, one per bucket, so the
+            # minimum and maximum need only be merged in once per run
+            starts = numpy.flatnonzero(numpy.concatenate( ([True], idx[1:] != idx[:-1]) ))
+            numpy.minimum.at(self._column('mins'), idx[starts], numpy.minimum.reduceat(got, starts))
+            numpy.maximum.at(self._column('maxs'), idx[starts], numpy.maximum.reduceat(got, starts))
+            if self.lastDatum is not None:
+                deltas = numpy.abs(numpy.diff(numpy.concatenate( ([self.lastDatum], got) )))
+                jdx = idx
+            else:
+                deltas = numpy.abs(numpy.diff(got))
+                jdx = idx[1:]
+            self._addCounts(self._column('jitters'), jdx, deltas)
+            self._addCounts(self._column('jitterCounts'), jdx)
+            bins = numpy.log10(numpy.maximum(got, self.SKETCH_MIN) / self.SKETCH_MIN) * (self.SKETCH_BINS / float(self.SKETCH_DECADES))
+            bins = numpy.minimum(bins.astype(int), self.SKETCH_BINS-1)
+            self._addCounts(numpy.frombuffer(self.sketch, dtype=numpy.uint16), idx*self.SKETCH_BINS + bins)
+            self.lastDatum = float(got[-1])
+        self.generation = next(TimeSeries.generations)
+
+    @staticmethod
+    def _addCounts(col, indexes, weights=None):
+        '''Adds 1 (or weights[i]) to col[indexes[i]] for each i, in one pass'''
+        col += numpy.bincount(indexes, weights, minlength=len(col)).astype(col.dtype)
+
+    def _column(self, name):
+        col = getattr(self, name)
+        return numpy.frombuffer(col, dtype=numpy.dtype(col.typecode))
+
+    # Whole columns of statistics, as numpy arrays with NaN for no data,
+    # or lists with None if numpy is not available
+
+    def meanColumn(self):
+        if numpy is None:
+            return [ self.mean(i) for i in range(self.length) ]
+        counts = self._column('counts')
+        return numpy.where(counts > 0, self._column('totals') / numpy.maximum(counts, 1), numpy.nan)
+
+    def minimumColumn(self):
+        if numpy is None:
+            return [ self.minimum(i) for i in range(self.length) ]
+        return numpy.where(self._column('counts') > 0, self._column('mins'), numpy.nan)
+
+    def maximumColumn(self):
+        if numpy is None:
+            return [ self.maximum(i) for i in range(self.length) ]
+        return numpy.where(self._column('counts') > 0, self._column('maxs'), numpy.nan)
+
+    # Statistics for bucket i; these return None if there is no data
+
+    def mean(self, i):
+        if self.counts[i] == 0:
+            return None
+        return self.totals[i] / self.counts[i]
+
+    def minimum(self, i):
+        if self.counts[i] == 0:
+            return None
+        return self.mins[i]
+
+    def maximum(self, i):
+        if self.counts[i] == 0:
+            return None
+        return self.maxs[i]
+
+    def jitter(self, i):
+        if self.jitterCounts[i] == 0:
+            return None
+        return self.jitters[i] / self.jitterCounts[i]
+
+    def lossRatio(self, i):
+        total = self.counts[i] + self.lost[i]
+        if total == 0:
+            return None
+        return float(self.lost[i]) / total
+
+    def percentile(self, i, q=0.95):
+        '''Approximate, from the sketch; clamped to the bucket's min and max'''
+        if self.counts[i] == 0:
+            return None
+        rank = q * self.counts[i]
+        seen = 0
+        base = i * self.SKETCH_BINS
+        for b in range(self.SKETCH_BINS):
+            seen += self.sketch[base+b]
+            if seen >= rank:
+                break
+        if seen == 0:
+            return None # No sketch, e.g. data from a rollup
+        # Geometric middle of the bin
+        value = self.SKETCH_MIN * math.pow(10.0, (b + 0.5) * self.SKETCH_DECADES / self.SKETCH_BINS)
+        return min(max(value, self.mins[i]), self.maxs[i])
                 
 class TimeGraph(Graph):
     def __init__(self, xUnits=24, xPixPerUnit=22, yAxis=None):
@@ -218,20 +695,86 @@ class TimeGraph(Graph):
         else:
             return ""
 
-    def plotSeriesAsBars(self, series, color):
+    def plotSeriesAsBars(self, series, color, stat=TimeSeries.mean):
         self.plotSeries = series
+        self.plotStat = stat
         return self.drawDataAsBars(color)
              
-    def plotSeriesAsLine(self, series, color):
+    def plotSeriesAsLine(self, series, color, stat=TimeSeries.mean):
         self.plotSeries = series
+        self.plotStat = stat
         return self.drawDataAsLine(color)
+
+    def plotPercentileAsLine(self, series, color, q=0.95):
+        return self.plotSeriesAsLine(series, color, lambda s, i: s.percentile(i, q))
+
+    def plotRangeAsBand(self, series, color):
+        '''Draws a band from the minimum to the maximum of each bucket'''
+        yTotal = self.yAxis.getHeight()
+        lows = self.yAxis.scaleColumn(series.minimumColumn(), yTotal)
+        highs = self.yAxis.scaleColumn(series.maximumColumn(), yTotal)
+        return self.fillColumns(lows, highs, color)
+
+    def plotLossMarkers(self, series, color, maxHeight=10):
+        '''Marks buckets with losses by a tick down from the top of the graph,
+           whose length shows the proportion lost'''
+        top = self.originY - self.yAxis.getHeight()
+        for pX in range(series.length):
+            ratio = series.lossRatio(pX)
+            if ratio:
+                self.draw.line( [ self.originX+pX, top, self.originX+pX, top + max(1, int(ratio*maxHeight)) ], fill=color )
+        return self
                 
     def generateData(self):
         s = self.plotSeries
         assert(s.length==self.xTotal)
         for pX in range(s.length):
-            if s.counts[pX]==0:
+            value = self.plotStat(s, pX)
+            if value is None:
                 yield (pX, None)
             else:
-                yield (pX, self.yAxis.scaleY(s.totals[pX] / s.counts[pX]))
+                yield (pX, self.yAxis.scaleY(value))
+
+    def generateHeights(self, limit):
+        s = self.plotSeries
+        assert(s.length==self.xTotal)
+        if self.plotStat == TimeSeries.mean:
+            values = s.meanColumn()
+        else:
+            values = [ self.plotStat(s, pX) for pX in range(s.length) ]
+        return self.yAxis.scaleColumn(values, limit)
+
+class HistoryGraph(TimeGraph):
+    '''A TimeGraph covering xUnits periods of unitSeconds each, up to
+       endTime (seconds since the epoch). The series plotted on it need
+       one bucket per pixel across the graph, from getStartTime() to
+       endTime; see rollup.RollupStore.getSeries().'''
+    def __init__(self, endTime, unitSeconds, labelFormat, labelEvery=1, xUnits=7, xPixPerUnit=75, yAxis=None):
+        TimeGraph.__init__(self, xUnits, xPixPerUnit, yAxis)
+        self.endTime = endTime
+        self.unitSeconds = unitSeconds
+        self.labelFormat = labelFormat
+        self.labelEvery = labelEvery
+
+    def getStartTime(self):
+        return self.endTime - self.xUnits * self.unitSeconds
+
+    def getBackgroundKey(self):
+        return TimeGraph.getBackgroundKey(self) + (self.endTime, self.unitSeconds, self.labelFormat, self.labelEvery)
+
+    def xLabel(self, x):
+        if (x % self.labelEvery) != 0:
+            return ""
+        return time.strftime(self.labelFormat, time.localtime(self.getStartTime() + x*self.unitSeconds))
+
+class WeekGraph(HistoryGraph):
+    def __init__(self, endTime, yAxis=None):
+        HistoryGraph.__init__(self, endTime, 86400, "%a", 1, xUnits=7, xPixPerUnit=75, yAxis=yAxis)
+
+class MonthGraph(HistoryGraph):
+    def __init__(self, endTime, yAxis=None):
+        HistoryGraph.__init__(self, endTime, 86400, "%d/%m", 5, xUnits=30, xPixPerUnit=17, yAxis=yAxis)
 
+class YearGraph(HistoryGraph):
+    def __init__(self, endTime, yAxis=None):
+        HistoryGraph.__init__(self, endTime, 365*86400/12, "%b", 1, xUnits=12, xPixPerUnit=44, yAxis=yAxis)
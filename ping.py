@@ -7,122 +7,808 @@
 # It comes with NO WARRANTY.
 
 import os, sys, time
+import signal
+import errno
+import fcntl
+import heapq
 import select
 import socket
 import struct
+import array
+import bisect
 import re
+import multiprocessing
 import site_config
-   
+import pinglog
+import metrics
+
+def _getMonotonicClock():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [ ("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long) ]
+        librt = ctypes.CDLL(ctypes.util.find_library("rt"), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+# Clock used for send times and timeouts; unaffected by changes to the date
+monotonic = _getMonotonicClock()
+
+re_DOTTED_QUAD = re.compile("^\d+\.\d+\.\d+\.\d+$")
+addressCache = {}
+
+stats = metrics.Metrics()
+stats.define("ping_probes_sent_total", "counter", "Echo requests sent")
+stats.define("ping_replies_total", "counter", "Echo replies matched to a request")
+stats.define("ping_stray_replies_total", "counter", "Packets received which were not replies to this process (not counted when sharded, as the kernel drops them)")
+stats.define("ping_unmatched_replies_total", "counter", "Replies to this process which matched no outstanding request (duplicates, wrong source)")
+stats.define("ping_send_errors_total", "counter", "Echo requests which could not be sent")
+stats.define("ping_sweep_seconds", "gauge", "Duration of the last sweep of each kind")
+stats.define("ping_sweep_probes", "gauge", "Echo requests sent in the last sweep of each kind")
+stats.define("ping_sweep_replies", "gauge", "Replies received in the last sweep of each kind")
+stats.define("ping_arp_lookups_total", "counter", "MAC address lookups")
+stats.define("ping_arp_fetches_total", "counter", "Fetches of the whole neighbour table")
+stats.define("ping_arp_fetch_seconds", "gauge", "Duration of the last neighbour table fetch")
+stats.define("ping_log_write_seconds", "gauge", "Time taken to write the last cycle's results to the log")
+stats.define("ping_last_cycle_timestamp", "gauge", "When the last measurement cycle finished, in seconds since the epoch")
+
+def resolveAddress(hostname):
+    '''Look up hostname, remembering the answer. Dotted quads are returned as-is'''
+    if re_DOTTED_QUAD.match(hostname):
+        return hostname
+    addr = addressCache.get(hostname)
+    if addr is None:
+        addr = socket.gethostbyname(hostname)
+        addressCache[hostname] = addr
+    return addr
+
+class PacketFactory:
+    '''Makes ECHO_REQUEST packets for one ident and payload. The packet and
+       its checksum are computed once with sequence number 0; each probe then
+       patches in its sequence number and updates the checksum incrementally
+       (RFC 1624).'''
+    factories = {}
+
+    def __init__(self, ident, payload):
+        self.ident = ident
+        self.payload = payload
+        template = struct.pack("!BBHHH", EchoRequest.ICMP_ECHO, 0, 0, ident, 0) + payload
+        # One's complement sum of the template, in network word order
+        self.baseSum = (~EchoRequest.getChecksum(template)) & 0xFFFF
+
+    @staticmethod
+    def get(ident, payload):
+        key = (ident, payload)
+        factory = PacketFactory.factories.get(key)
+        if factory is None:
+            factory = PacketFactory(ident, payload)
+            PacketFactory.factories[key] = factory
+        return factory
+
+    def makePacket(self, sequence):
+        csum = self.baseSum + sequence
+        csum = (csum & 0xFFFF) + (csum >> 16)
+        return struct.pack("!BBHHH", EchoRequest.ICMP_ECHO, 0, (~csum) & 0xFFFF, self.ident, sequence) + self.payload
+
 class EchoRequest:
     ICMP_ECHO = 8
+    ICMP_ECHOREPLY = 0
     def __init__(self, hostname, ident, sequence, payload='\x55' * 56):
         self.hostname = hostname
-        self.destAddr = socket.gethostbyname(hostname)
-        packet = struct.pack("!BBHHH", self.ICMP_ECHO, 0, 0, ident, sequence) + payload
-        checksum = self.getChecksum(packet)
-        self.packet = packet[0:2] + struct.pack("!H", checksum) + packet[4:]
+        self.destAddr = resolveAddress(hostname)
+        self.packet = PacketFactory.get(ident, payload).makePacket(sequence)
         self.ID = (ident << 16) | sequence
         self.delay = None
+        self.receiveTime = None
+        self.timedOut = False
 
     @staticmethod 
     def getChecksum(packet):
-        if (len(packet) & 1) != 0:
-            packet += '\x00'
-        csum = sum([ (ord(packet[i+1]) << 8) + ord(packet[i]) for i in range(0, len(packet), 2) ]) & 0xFFFFFFFF
+        '''packet may be a string, bytearray, memoryview or array of 16-bit words'''
+        if isinstance(packet, array.array) and packet.itemsize == 2:
+            words = packet
+        else:
+            data = memoryview(packet).tobytes()
+            if (len(data) & 1) != 0:
+                data += '\x00'
+            words = array.array('H', data)
+        csum = sum(words)
         # Random twiddling, cf. in_cksum() in ping.c
         csum = (csum >> 16) + (csum & 0xFFFF);
         csum += (csum >> 16)
         csum = socket.htons((~csum) & 0xFFFF)
         return csum
+
+    @staticmethod
+    def getReplyId(packet):
+        '''Returns the (ident << 16 | sequence) of an IP packet holding an ICMP
+           ECHO_REPLY, or None if it is anything else'''
+        if len(packet) < 20:
+            return None
+        hdrLen = (struct.unpack_from("!B", packet, 0)[0] & 0x0F) * 4
+        if len(packet) < hdrLen + 8:
+            return None
+        (icmpType, code, _, ident, sequence) = struct.unpack_from("!BBHHH", packet, hdrLen)
+        if icmpType != EchoRequest.ICMP_ECHOREPLY or code != 0:
+            return None
+        return (ident << 16) | sequence
         
     def getId(self):
         return self.ID
         
     def send(self, sock):
-        self.sendTime = time.time()
+        self.sendTime = monotonic()
         sock.sendto(self.packet, (self.destAddr, 1))
 
-    def checkResponse(self, receiveTime, fromAddr, packet):
-        # TODO: Check packet and address
-        self.delay = receiveTime - self.sendTime
+    def checkResponse(self, receiveTime, receiveClock, fromAddr, packet):
+        '''Records the reply if packet is our ECHO_REPLY, from the address we
+           pinged, and the first one seen. Returns True if it was.
+           receiveTime is wall-clock time; receiveClock is on the monotonic()
+           clock, as is the send time.'''
+        if self.delay != None or fromAddr[0] != self.destAddr:
+            return False
+        if self.getReplyId(packet) != self.ID:
+            return False
+        self.receiveTime = receiveTime
+        self.delay = max(receiveClock - self.sendTime, 0.0)
+        return True
 
     def getDelay(self):
         return self.delay
 
+    def getReceiveTime(self):
+        return self.receiveTime
+
     def show(self):
         if self.delay==None:
             print self.hostname, "did not reply"
         else:
             print self.hostname, "replied in %5.1f ms" % (self.delay*1000.0)
 
+
+class IcmpSocket:
+    '''Non-blocking raw ICMP socket which reports when the kernel received
+       each packet'''
+    SO_TIMESTAMPNS = 35  # From <asm-generic/socket.h>
+    SO_ATTACH_FILTER = 26
+    SO_RCVBUFFORCE = 33
+    SIOCGSTAMP = 0x8906  # From <asm-generic/sockios.h>
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        self.sock.setblocking(0)
+        # Ancillary data needs recvmsg(); otherwise ask for the timestamp
+        # of the last packet with an ioctl.
+        self.useCmsg = hasattr(self.sock, "recvmsg_into")
+        if self.useCmsg:
+            self.sock.setsockopt(socket.SOL_SOCKET, self.SO_TIMESTAMPNS, 1)
+            self.cmsgSize = socket.CMSG_SPACE(struct.calcsize("ll"))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setReceiveBuffer(self, nbytes):
+        '''Asks for a receive buffer of nbytes, beyond the usual limit
+           (net.core.rmem_max) if we are root. Returns the size given.'''
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, self.SO_RCVBUFFORCE, nbytes)
+        except socket.error:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, nbytes)
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def setIdentFilter(self, ident):
+        '''Asks the kernel to pass on only ECHO_REPLYs for ident, so that
+           other pingers' replies cost us nothing. Returns False if it
+           can't be done.'''
+        # Classic BPF, run on the IP packet: X = IP header length,
+        # then check the ICMP type and ident
+        program = [ (0xb1, 0, 0, 0),                          # ldxb 4*([0]&0xf)
+                    (0x50, 0, 0, 0),                          # ldb [x+0]
+                    (0x15, 0, 3, EchoRequest.ICMP_ECHOREPLY), # jeq #0, else drop
+                    (0x48, 0, 0, 4),                          # ldh [x+4]
+                    (0x15, 0, 1, ident),                      # jeq #ident, else drop
+                    (0x06, 0, 0, 0xFFFF),                     # ret #0xFFFF (accept)
+                    (0x06, 0, 0, 0) ]                         # ret #0 (drop)
+        try:
+            import ctypes
+            code = ctypes.create_string_buffer("".join([ struct.pack("HBBI", *insn) for insn in program ]))
+            fprog = struct.pack("HL", len(program), ctypes.addressof(code))
+            self.sock.setsockopt(socket.SOL_SOCKET, self.SO_ATTACH_FILTER, fprog)
+            return True
+        except (ImportError, socket.error) as e:
+            print "Cannot filter replies:", str(e)
+            return False
+
+    def sendto(self, packet, addr):
+        return self.sock.sendto(packet, addr)
+
+    def receive(self, buf):
+        '''Reads one packet into buf. Returns (nbytes, fromAddr, stamp), where
+           stamp is the wall-clock time the kernel received the packet (or
+           None if not known), or None if there is nothing to read.'''
+        stamp = None
+        try:
+            if self.useCmsg:
+                (nbytes, ancdata, _, fromAddr) = self.sock.recvmsg_into([buf], self.cmsgSize)
+                for (level, ctype, data) in ancdata:
+                    if level == socket.SOL_SOCKET and ctype == self.SO_TIMESTAMPNS:
+                        (sec, nsec) = struct.unpack("ll", data[:struct.calcsize("ll")])
+                        stamp = sec + nsec * 1e-9
+            else:
+                (nbytes, fromAddr) = self.sock.recvfrom_into(buf)
+                try:
+                    tv = fcntl.ioctl(self.sock.fileno(), self.SIOCGSTAMP, struct.pack("ll", 0, 0))
+                    (sec, usec) = struct.unpack("ll", tv)
+                    stamp = sec + usec * 1e-6
+                except IOError:
+                    pass
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        return (nbytes, fromAddr, stamp)
+
+
+def readReplies(sock, buf):
+    '''Reads everything waiting on sock into buf, yielding
+       (pkid, receiveTime, receiveClock, fromAddr, packet) for each packet,
+       where pkid is as for EchoRequest.getReplyId(). The packet is only
+       valid until the next one is read.'''
+    while True:
+        got = sock.receive(buf)
+        if got == None:
+            return
+        (nbytes, fromAddr, stamp) = got
+        wallNow = time.time()
+        receiveClock = monotonic()
+        if stamp != None:
+            # Backdate to when the kernel had it
+            receiveClock -= max(wallNow - stamp, 0.0)
+        else:
+            stamp = wallNow
+        packet = memoryview(buf)[:nbytes]
+        yield (EchoRequest.getReplyId(packet), stamp, receiveClock, fromAddr, packet)
+
         
+def packAddress(addr):
+    '''Returns a dotted-quad address as an unsigned 32-bit integer'''
+    return struct.unpack("!L", socket.inet_aton(addr)) [0]
+
+def unpackAddress(addr):
+    '''Returns a packed address (see packAddress()) as a dotted quad'''
+    return socket.inet_ntoa(struct.pack("!L", addr))
+
+def packAddresses(hosts):
+    '''Returns an array of the packed addresses of hosts, which may be
+       names or dotted quads; an array is returned as it is'''
+    if isinstance(hosts, array.array):
+        return hosts
+    return array.array('I', [ packAddress(resolveAddress(h)) for h in hosts ])
+
+NAN = float("nan")
+
+class SweepResults:
+    '''The outcome of a sweep, as arrays with an entry for each host
+       pinged, in the order given: its address (packed, see packAddress()),
+       the probe's ID, the round-trip time in seconds and the wall-clock
+       time of the reply; the last two are NaN for no reply. getDelay()
+       etc. give single entries, and iterating gives a ProbeResult for
+       each, for code which wants an object per probe.'''
+    def __init__(self, addrs):
+        n = len(addrs)
+        self.addrs = addrs
+        self.ids = array.array('I', [0]) * n
+        self.delays = array.array('d', [NAN]) * n
+        self.receiveTimes = array.array('d', [NAN]) * n
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def getAddress(self, i):
+        '''Returns the i'th address as a dotted quad'''
+        return unpackAddress(self.addrs[i])
+
+    def getDelay(self, i):
+        delay = self.delays[i]
+        if delay != delay:
+            return None
+        return delay
+
+    def getReceiveTime(self, i):
+        t = self.receiveTimes[i]
+        if t != t:
+            return None
+        return t
+
+    def getResult(self, i):
+        addr = self.getAddress(i)
+        return ProbeResult(addr, addr, self.ids[i], self.getDelay(i), self.getReceiveTime(i))
+
+    def __iter__(self):
+        for i in xrange(len(self.addrs)):
+            yield self.getResult(i)
+
+    def getReplied(self):
+        '''Returns the packed addresses which replied, as an array'''
+        (addrs, delays) = (self.addrs, self.delays)
+        return array.array('I', [ addrs[i] for i in xrange(len(delays)) if delays[i] == delays[i] ])
+
+    def countReplies(self):
+        return len([ d for d in self.delays if d == d ])
+
+    def pack(self):
+        '''Returns the arrays as strings, e.g. to send to another process'''
+        return (self.ids.tostring(), self.delays.tostring(), self.receiveTimes.tostring())
+
+    def unpack(self, packed):
+        '''Fills the arrays from what pack() returned, for the same addresses'''
+        for (a, data) in zip( (self.ids, self.delays, self.receiveTimes), packed ):
+            del a[:]
+            a.fromstring(data)
+        return self
+
 class Pinger:
-    def __init__(self, timeout=1.0, packet_size=56):
+    '''Sends pings and collects the replies. If minTimeout is given, each
+       host's timeout adapts to its round-trip times as TCP's does
+       (RFC 6298): the smoothed RTT plus four times its variation, but
+       no less than minTimeout and no more than timeout. A probe lost
+       doubles the host's timeout until it answers again. Otherwise every
+       probe waits for timeout.
+       Probes in flight are kept in a table of arrays indexed by sequence
+       number, allocated once, so a sweep makes no object per probe.
+       If filterReplies is set, the socket Pinger makes for itself passes
+       on only replies to it (see IcmpSocket.setIdentFilter()), so other
+       pingers' replies are not even counted as strays.
+       Probes are sent at most BURST at a time, with whatever replies have
+       come in read in between, and the receive buffer of a socket Pinger
+       makes is made big enough to hold every reply which can be waiting,
+       so that replies are not dropped when many hosts are pinged at once.'''
+    SLOTS = 0x10000
+    NOSLOT = -1
+    BURST = 100
+    REPLY_BUFFER = 2048        # Receive buffer taken by each reply waiting to be read
+    MAX_RCVBUF = 16 * 1024 * 1024
+
+    def __init__(self, timeout=1.0, packet_size=56, sock=None, minTimeout=None, ident=None,
+                 filterReplies=False):
         self.timeout = timeout
+        self.minTimeout = minTimeout
+        self.rttState = {} # Packed address -> [smoothed RTT, RTT variation, backoff]
         self.packet_size = packet_size
-        self.own_id = os.getpid() & 0xFFFF
+        if ident == None:
+            ident = os.getpid() & 0xFFFF
+        self.own_id = ident
+        self.payload = "\x55" * packet_size
+        self.packets = PacketFactory.get(self.own_id, self.payload)
+
+        # The probe table. A slot holds the index of the probe's entry in
+        # its sweep's results, or NOSLOT if it is free.
+        self.slotIndex = array.array('i', [self.NOSLOT]) * self.SLOTS
+        self.slotAddr = array.array('I', [0]) * self.SLOTS
+        self.slotSendTime = array.array('d', [0.0]) * self.SLOTS
+        self.slotDeadline = array.array('d', [0.0]) * self.SLOTS
+        self.slotLate = array.array('B', [0]) * self.SLOTS
 
         self.seq_number = 0
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        self.rcvbuf = 0 # Receive buffer asked for, if we made the socket
+        self.ownSocket = (sock == None)
+        if sock == None:
+            sock = IcmpSocket()
+            if filterReplies:
+                sock.setIdentFilter(self.own_id)
+        self.socket = sock
+        self.buffer = bytearray(2048)
 
     #--------------------------------------------------------------------------
 
+    def getTimeout(self, addr):
+        '''addr is packed (see packAddress())'''
+        state = self.rttState.get(addr)
+        if self.minTimeout == None or state == None:
+            return self.timeout
+        (srtt, rttvar, backoff) = state
+        return min(max(srtt + 4.0*rttvar, self.minTimeout) * backoff, self.timeout)
+
+    def _addRtt(self, addr, rtt, late=False):
+        '''Adds an RTT sample; if the reply came after the timeout, the
+           timeout stays backed off'''
+        state = self.rttState.get(addr)
+        if state == None:
+            self.rttState[addr] = [ rtt, rtt / 2.0, 1 ]
+        else:
+            state[1] = 0.75*state[1] + 0.25*abs(state[0] - rtt)
+            state[0] = 0.875*state[0] + 0.125*rtt
+            if not late:
+                state[2] = 1
+
+    def _addLoss(self, addr):
+        state = self.rttState.get(addr)
+        if state != None and state[2] < 64:
+            state[2] *= 2
+
+    def _sizeReceiveBuffer(self, nprobes, rate):
+        '''Makes our own socket's receive buffer big enough for the replies
+           to every probe which can be in flight at once'''
+        if not self.ownSocket:
+            return
+        inFlight = nprobes
+        if rate:
+            inFlight = min(nprobes, int(rate * self.timeout) + self.BURST)
+        want = min(inFlight * self.REPLY_BUFFER, self.MAX_RCVBUF)
+        if want > self.rcvbuf:
+            self.socket.setReceiveBuffer(want)
+            self.rcvbuf = want
+
+    def _send(self, packet, destAddr):
+        '''Sends packet, waiting up to self.timeout for room if the socket's
+           send buffer is full. Returns when it was sent, or None if it
+           could not be.'''
+        deadline = monotonic() + self.timeout
+        while True:
+            try:
+                sendTime = monotonic()
+                self.socket.sendto(packet, (destAddr, 1))
+                return sendTime
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) and monotonic() < deadline:
+                    select.select([], [self.socket], [], max(deadline - monotonic(), 0.0))
+                    continue
+                print "Socket error:", str(e), "-- continuing anyway"
+                return None
+
     def ping(self, destlist):
         """
-Send one ICMP ECHO_REQUEST and receive the response until self.timeout
+Send one ICMP ECHO_REQUEST to each of destlist and receive the responses until self.timeout
 """
-        reqs = {}
-        reqlist = []
-        for dest in destlist:
-            self.seq_number = (self.seq_number + 1) & 0xFFFF
-            req = EchoRequest(dest, self.own_id, self.seq_number, "\x55" * self.packet_size)
-            reqs[req.getId()] = req
-            reqlist.append(req)
-
-        for req in reqlist:
-            try:
-                req.send(self.socket)
-            except socket.error as e:
-                print "Socket error:", str(e), "-- scontinuing anyway"
+        return self.sweep(destlist, rate=None)
+
+    def sweep(self, destlist, rate):
+        """
+Send ICMP ECHO_REQUESTs to destlist at 'rate' packets per second (or as fast
+as replies can be read if rate is None), collecting responses as they arrive,
+and return them as SweepResults. destlist is best given as an array of packed
+addresses (see packAddresses()), which is used as it is. Each probe times out
+getTimeout() after it was sent, so a sweep takes len(destlist)/rate seconds
+plus at most one timeout. A reply which comes after its probe timed out still
+counts if the sweep is still going, and self.timeout has not passed.
+"""
+        destlist = packAddresses(destlist)
+        self._sizeReceiveBuffer(len(destlist), rate)
+        results = SweepResults(destlist)
+        (addrs, ids, delays, receiveTimes) = (results.addrs, results.ids, results.delays, results.receiveTimes)
+        (slotIndex, slotAddr, slotSendTime, slotDeadline, slotLate) = \
+            (self.slotIndex, self.slotAddr, self.slotSendTime, self.slotDeadline, self.slotLate)
+        NOSLOT = self.NOSLOT
+        # Heap of the deadlines of probes sent and not yet timed out, each
+        # an integer: microseconds << 16 | sequence number
+        waiting = []
+        # Sequence numbers and send times of the probes sent, in order;
+        # each slot is freed self.timeout after its probe was sent
+        sentSeqs = array.array('H')
+        sentTimes = array.array('d')
+        nextFree = 0
+        outstanding = 0
+        if rate:
+            interval = 1.0 / rate
+        else:
+            interval = 0.0
+        nextSend = monotonic()
+        toSend = 0
+        (replies, strays, unmatched, sendErrors) = (0, 0, 0, 0)
+
+        while True:
+            now = monotonic()
 
-        stopTime = time.time() + self.timeout
-                
-        while True: # Loop while waiting for packet or timeout
-            maxWait = stopTime - time.time()
-            if maxWait <= 0.0:
+            # Send any probes which are due, a burst at a time
+            burst = 0
+            while toSend < len(destlist) and nextSend <= now and burst < self.BURST:
+                burst += 1
+                self.seq_number = seq = (self.seq_number + 1) & 0xFFFF
+                i = toSend
+                toSend += 1
+                nextSend += interval
+                addr = addrs[i]
+                ids[i] = (self.own_id << 16) | seq
+                if slotIndex[seq] != NOSLOT and not slotLate[seq]:
+                    # Still waiting after 64K more probes; give up on it
+                    outstanding -= 1
+                slotIndex[seq] = NOSLOT
+                sendTime = self._send(self.packets.makePacket(seq), unpackAddress(addr))
+                if sendTime == None:
+                    sendErrors += 1
+                    continue
+                deadline = sendTime + self.getTimeout(addr)
+                slotIndex[seq] = i
+                slotAddr[seq] = addr
+                slotSendTime[seq] = sendTime
+                slotDeadline[seq] = deadline
+                slotLate[seq] = 0
+                heapq.heappush(waiting, (int(deadline * 1e6) << 16) | seq)
+                sentSeqs.append(seq)
+                sentTimes.append(sendTime)
+                outstanding += 1
+
+            # Stop waiting for probes which have timed out, but go on
+            # listening for their replies until self.timeout has passed
+            nowUs = int(now * 1e6)
+            while len(waiting) > 0 and (waiting[0] >> 16) <= nowUs:
+                entry = heapq.heappop(waiting)
+                seq = entry & 0xFFFF
+                # The slot may have been answered, or reused
+                if slotIndex[seq] != NOSLOT and not slotLate[seq] and int(slotDeadline[seq] * 1e6) == (entry >> 16):
+                    outstanding -= 1
+                    slotLate[seq] = 1
+                    self._addLoss(slotAddr[seq])
+            while nextFree < len(sentSeqs) and sentTimes[nextFree] + self.timeout <= now:
+                seq = sentSeqs[nextFree]
+                if slotSendTime[seq] == sentTimes[nextFree]:
+                    slotIndex[seq] = NOSLOT
+                nextFree += 1
+
+            if toSend < len(destlist):
+                stopTime = nextSend
+                if len(waiting) > 0:
+                    stopTime = min(stopTime, (waiting[0] >> 16) * 1e-6)
+            elif outstanding > 0:
+                stopTime = (waiting[0] >> 16) * 1e-6
+            else:
                 break
 
+            maxWait = max(stopTime - monotonic(), 0.0)
             (inputs, _, _) = select.select([self.socket], [], [], maxWait)
-            receiveTime = time.time()
+            if len(inputs) == 0:
+                continue
 
-            for sock in inputs:
-                (packet, fromAddr) = self.socket.recvfrom(2048)
-                (_, _, _, ident, sequence) = struct.unpack("!BBHHH", packet[20:28])
+            for (pkid, stamp, receiveClock, fromAddr, packet) in readReplies(self.socket, self.buffer):
+                if pkid == None or (pkid >> 16) != self.own_id:
+                    strays += 1
+                    continue
+                seq = pkid & 0xFFFF
+                i = slotIndex[seq]
+                if i == NOSLOT or slotAddr[seq] != packAddress(fromAddr[0]):
+                    # Duplicate, too late, or from the wrong host
+                    unmatched += 1
+                    continue
+                slotIndex[seq] = NOSLOT
+                delay = max(receiveClock - slotSendTime[seq], 0.0)
+                delays[i] = delay
+                receiveTimes[i] = stamp
+                if not slotLate[seq]:
+                    outstanding -= 1
+                replies += 1
+                self._addRtt(slotAddr[seq], delay, slotLate[seq])
 
-                pkid = (ident << 16) | sequence
-                if pkid in reqs:
-                    reqs[pkid].checkResponse(receiveTime, fromAddr, packet)
-                else:
-                    pass
-                    #print "Unknown reply from", fromAddr, "ident", hex(pkid)
+        # Replies to anything still in the table would be too late now
+        for j in xrange(nextFree, len(sentSeqs)):
+            seq = sentSeqs[j]
+            if slotSendTime[seq] == sentTimes[j]:
+                slotIndex[seq] = NOSLOT
 
-            # Early exit if we got everybody
-            if len([r for r in reqlist if r.getDelay()==None])==0:
-                break
-                
-        return reqlist
+        stats.inc("ping_probes_sent_total", len(destlist) - sendErrors)
+        stats.inc("ping_replies_total", replies)
+        stats.inc("ping_stray_replies_total", strays)
+        stats.inc("ping_unmatched_replies_total", unmatched)
+        stats.inc("ping_send_errors_total", sendErrors)
+        return results
+
+class ProbeResult:
+    '''The outcome of one probe of a sweep (see SweepResults), with the
+       same accessors as an EchoRequest'''
+    def __init__(self, hostname, destAddr, ID, delay, receiveTime):
+        self.hostname = hostname
+        self.destAddr = destAddr
+        self.ID = ID
+        self.delay = delay
+        self.receiveTime = receiveTime
+
+    def getId(self):
+        return self.ID
+
+    def getDelay(self):
+        return self.delay
+
+    def getReceiveTime(self):
+        return self.receiveTime
+
+def runShard(conn, sockFactory, ident, timeout, packet_size, minTimeout):
+    '''Body of a ShardedPinger worker process: sweeps whatever it is sent,
+       and sends back the results and what it added to the counters'''
+    sock = None
+    if sockFactory != None:
+        sock = sockFactory()
+    p = Pinger(timeout, packet_size, sock=sock, minTimeout=minTimeout, ident=ident, filterReplies=True)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            job = None # The coordinator has gone
+        if job == None:
+            return
+        (destlist, rate) = job
+        before = dict(stats.values)
+        results = p.sweep(array.array('I', destlist), rate)
+        counts = dict([ (name, value - before.get(name, 0)) for (name, value) in stats.values.iteritems()
+                        if name.endswith("_total") ])
+        conn.send( (results.pack(), counts) )
+
+class ShardedPinger:
+    '''Works like Pinger, but splits each sweep between nshards worker
+       processes, each with its own socket and ident (so each sees only
+       its own replies) and its own share of the rate. Each address always
+       goes to the same shard, which keeps its RTT history. Results come
+       back in the order asked for. If a shard fails or hangs, it is
+       restarted and its addresses are left out of that sweep's results;
+       the other shards carry on. sockFactory, if given, is called in each
+       worker to make its socket.'''
+    def __init__(self, nshards, timeout=1.0, packet_size=56, minTimeout=None, sockFactory=None):
+        # Each shard needs its own ident, different from ours
+        if not 1 <= nshards < 0xFFFF:
+            raise ValueError("Cannot have %d ping shards" % nshards)
+        self.nshards = nshards
+        self.timeout = timeout
+        self.args = (sockFactory, timeout, packet_size, minTimeout)
+        self.baseIdent = os.getpid() & 0xFFFF
+        self.shards = [ None ] * nshards # (process, connection)
+        for i in range(nshards):
+            self._start(i)
+
+    def _start(self, i):
+        (sockFactory, timeout, packet_size, minTimeout) = self.args
+        (conn, childConn) = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=runShard, name="ping-shard-%d" % i,
+                                       args=(childConn, sockFactory, (self.baseIdent + 1 + i) & 0xFFFF,
+                                             timeout, packet_size, minTimeout))
+        proc.daemon = True
+        proc.start()
+        childConn.close()
+        self.shards[i] = (proc, conn)
+
+    def _restart(self, i, why):
+        print "Ping shard", i, why, "-- restarting it"
+        (proc, conn) = self.shards[i]
+        conn.close()
+        if proc.is_alive():
+            # It may be stopped or stuck, so it might not notice SIGTERM
+            os.kill(proc.pid, signal.SIGKILL)
+        proc.join()
+        self._start(i)
+
+    def close(self):
+        for (proc, conn) in self.shards:
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+        for (proc, conn) in self.shards:
+            proc.join(self.timeout)
+            if proc.is_alive():
+                proc.terminate()
+
+    def getShard(self, addr):
+        '''addr is packed (see packAddress())'''
+        return addr % self.nshards
+
+    def ping(self, destlist):
+        return self.sweep(destlist, rate=None)
+
+    def sweep(self, destlist, rate):
+        destlist = packAddresses(destlist)
+        parts = [ array.array('I') for i in range(self.nshards) ]
+        which = array.array('H', [ self.getShard(addr) for addr in destlist ])
+        for (addr, i) in zip(destlist, which):
+            parts[i].append(addr)
+        shardRate = None
+        if rate:
+            shardRate = float(rate) / self.nshards
+        sent = []
+        for i in range(self.nshards):
+            if len(parts[i]) == 0:
+                continue
+            try:
+                self.shards[i][1].send( (parts[i].tostring(), shardRate) )
+                sent.append(i)
+            except (IOError, EOFError) as e:
+                self._restart(i, "could not be sent work (%s)" % str(e))
+
+        # Allow for the longest shard's sweep, and a bit
+        longest = max([ len(part) for part in parts ] + [0])
+        deadline = monotonic() + self.timeout + 5.0
+        if shardRate:
+            deadline += longest / shardRate
+        results = [ None ] * self.nshards
+        for i in sent:
+            (proc, conn) = self.shards[i]
+            try:
+                while not conn.poll(0.5):
+                    if not proc.is_alive():
+                        raise EOFError("exited")
+                    if monotonic() > deadline:
+                        raise EOFError("timed out")
+                (packed, counts) = conn.recv()
+                results[i] = SweepResults(parts[i]).unpack(packed)
+                for (name, value) in counts.iteritems():
+                    stats.inc(name, value)
+            except (IOError, EOFError) as e:
+                self._restart(i, "failed (%s)" % (str(e) or "exited"))
+
+        # Put the results back in the order asked for
+        order = []
+        nextResult = [ 0 ] * self.nshards
+        for (j, i) in enumerate(which):
+            if results[i] != None:
+                order.append( (j, i, nextResult[i]) )
+                nextResult[i] += 1
+        merged = SweepResults(array.array('I', [ destlist[j] for (j, i, k) in order ]))
+        for (m, (j, i, k)) in enumerate(order):
+            part = results[i]
+            merged.ids[m] = part.ids[k]
+            merged.delays[m] = part.delays[k]
+            merged.receiveTimes[m] = part.receiveTimes[k]
+        return merged
 
 class ARP:
+    '''Maps IPv4 addresses to MAC addresses using the kernel's neighbour
+       table. The whole table is fetched in one netlink RTM_GETNEIGH dump
+       (or from /proc/net/arp if netlink is unavailable) and answers are
+       kept for 'ttl' seconds; addresses with no entry are remembered for
+       'negativeTtl' seconds. The table is fetched at most once per
+       negativeTtl, however many lookups miss. If 'subscribe' is set,
+       neighbour-change notifications are read by poll() to keep entries
+       up to date between fetches.'''
     ARP_FILE="/proc/net/arp"
     re_IPV4 = re.compile("(\d+.\d+.\d+.\d+)\s+")
+
+    # From <linux/netlink.h>, <linux/rtnetlink.h> and <linux/neighbour.h>
+    NETLINK_ROUTE = 0
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x01
+    NLM_F_DUMP = 0x300
+    RTM_NEWNEIGH = 28
+    RTM_DELNEIGH = 29
+    RTM_GETNEIGH = 30
+    RTMGRP_NEIGH = 0x04
+    NDA_DST = 1
+    NDA_LLADDR = 2
+    NUD_INCOMPLETE = 0x01
+    NUD_FAILED = 0x20
+    NLMSG_HEADER = struct.Struct("=LHHLL")
+    NDMSG = struct.Struct("=BBHiHBB")
+    RTATTR = struct.Struct("=HH")
     
-    def __init__(self):
+    def __init__(self, ttl=60.0, negativeTtl=10.0, subscribe=False):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.useNetlink = hasattr(socket, "AF_NETLINK")
+        self.monitor = None
+        if subscribe and self.useNetlink:
+            try:
+                self.monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_ROUTE)
+                self.monitor.bind( (0, self.RTMGRP_NEIGH) )
+                self.monitor.setblocking(0)
+            except socket.error as e:
+                print "Cannot monitor neighbour table:", str(e)
+                self.monitor = None
         self.reset()
 
     def reset(self):
-        self.arpTable = {}
+        self.arpTable = {} # IP -> (MAC or "-", expiry time)
+        self.nextFetch = 0.0
 
-    def _update(self):
+    def _fetchProc(self):
+        table = {}
         with open(self.ARP_FILE, "r") as f:
             for line in f:
                 m = self.re_IPV4.match(line)
@@ -130,62 +816,327 @@ class ARP:
                     continue
                 (ip, hwtype, flags, addr, mask, device) = line.split()
                 if flags != "0x0" and addr != "00:00:00:00:00:00":
-                    self.arpTable[ip] = addr
+                    table[ip] = addr
+        return table
+
+    def _parseNeighbours(self, data):
+        '''Yields (msgType, ip, mac) for each netlink message in data; ip and
+           mac are None if the message isn't about a usable IPv4 entry'''
+        offset = 0
+        while offset + self.NLMSG_HEADER.size <= len(data):
+            (msgLen, msgType, flags, seq, pid) = self.NLMSG_HEADER.unpack_from(data, offset)
+            if msgLen < self.NLMSG_HEADER.size:
+                return
+            body = offset + self.NLMSG_HEADER.size
+            end = offset + msgLen
+            offset += (msgLen + 3) & ~3
+            (ip, mac) = (None, None)
+            if msgType in (self.RTM_NEWNEIGH, self.RTM_DELNEIGH):
+                (family, _, _, ifindex, state, nflags, ntype) = self.NDMSG.unpack_from(data, body)
+                attr = body + self.NDMSG.size
+                while attr + self.RTATTR.size <= end:
+                    (attrLen, attrType) = self.RTATTR.unpack_from(data, attr)
+                    if attrLen < self.RTATTR.size:
+                        break
+                    value = data[attr + self.RTATTR.size : attr + attrLen]
+                    if attrType == self.NDA_DST and len(value) == 4:
+                        ip = socket.inet_ntoa(value)
+                    elif attrType == self.NDA_LLADDR and len(value) == 6:
+                        mac = ":".join([ "%02x" % ord(c) for c in value ])
+                    attr += (attrLen + 3) & ~3
+                if family != socket.AF_INET or (state & (self.NUD_INCOMPLETE | self.NUD_FAILED)) != 0 \
+                        or mac == "00:00:00:00:00:00":
+                    mac = None
+            yield (msgType, ip, mac)
+
+    def _fetchNetlink(self):
+        table = {}
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_ROUTE)
+        try:
+            sock.bind( (0, 0) )
+            request = self.NDMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0)
+            sock.send(self.NLMSG_HEADER.pack(self.NLMSG_HEADER.size + len(request), self.RTM_GETNEIGH,
+                                             self.NLM_F_REQUEST | self.NLM_F_DUMP, 1, 0) + request)
+            while True:
+                for (msgType, ip, mac) in self._parseNeighbours(sock.recv(65536)):
+                    if msgType == self.NLMSG_DONE:
+                        return table
+                    elif msgType == self.NLMSG_ERROR:
+                        raise socket.error("RTM_GETNEIGH request failed")
+                    elif msgType == self.RTM_NEWNEIGH and ip != None and mac != None:
+                        table[ip] = mac
+        finally:
+            sock.close()
+
+    def _fetch(self):
+        if self.useNetlink:
+            try:
+                return self._fetchNetlink()
+            except socket.error as e:
+                print "Netlink neighbour dump failed (%s), using %s" % (str(e), self.ARP_FILE)
+                self.useNetlink = False
+        return self._fetchProc()
+
+    def poll(self):
+        '''Applies any neighbour-change notifications received'''
+        if self.monitor == None:
+            return
+        expiry = monotonic() + self.ttl
+        while True:
+            try:
+                data = self.monitor.recv(65536)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print "Neighbour monitor error:", str(e)
+                return
+            for (msgType, ip, mac) in self._parseNeighbours(data):
+                if ip == None:
+                    continue
+                if msgType == self.RTM_NEWNEIGH and mac != None:
+                    self.arpTable[ip] = (mac, expiry)
+                else:
+                    self.arpTable.pop(ip, None)
+
+    def _refresh(self, now):
+        '''Fetches the whole table, if it is not too soon since last time.
+           Returns True if it did.'''
+        if now < self.nextFetch:
+            return False
+        self.nextFetch = now + self.negativeTtl
+        expiry = now + self.ttl
+        stats.inc("ping_arp_fetches_total")
+        with stats.timer("ping_arp_fetch_seconds"):
+            table = self._fetch()
+        for (addr, mac) in table.iteritems():
+            self.arpTable[addr] = (mac, expiry)
+        return True
 
     def getMacAddress(self, ip):
-        if ip in self.arpTable:
-            return self.arpTable[ip]
-        self._update()
-        return self.arpTable.get(ip, "-")
+        stats.inc("ping_arp_lookups_total")
+        now = monotonic()
+        entry = self.arpTable.get(ip)
+        if entry != None and entry[1] > now:
+            return entry[0]
+        if self._refresh(now):
+            entry = self.arpTable.get(ip)
+            if entry != None and entry[1] > now:
+                return entry[0]
+        self.arpTable[ip] = ("-", now + self.negativeTtl)
+        return "-"
+
+    def getNeighbours(self):
+        '''Returns a dictionary of IP -> MAC address for every neighbour
+           currently known'''
+        now = monotonic()
+        self._refresh(now)
+        return dict([ (ip, mac) for (ip, (mac, expiry)) in self.arpTable.iteritems()
+                      if mac != "-" and expiry > now ])
+
+class ProbeScheduler:
+    '''Decides when to look again for a device at each address which has
+       not replied yet. An address which keeps not replying is tried
+       again after minInterval seconds, then twice that, and so on, up to
+       maxInterval; priority addresses (e.g. known devices) are tried at
+       least every priorityInterval. So a new device is found within
+       maxInterval (plus a sweep) wherever it turns up.
+       The state is kept in arrays, a few bytes per address.'''
+    LIVE = 0x01
+    PRIORITY = 0x02
 
-def doPing(args):
-    p = Pinger(timeout=2)
-    firstIp = struct.unpack("!L", socket.inet_aton(site_config.first_ip)) [0]
-    lastIp = struct.unpack("!L", socket.inet_aton(site_config.last_ip)) [0]
+    def __init__(self, addresses, minInterval, maxInterval, priorityInterval):
+        '''addresses is an array of packed addresses (see packAddress())'''
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.priorityInterval = priorityInterval
+        self.start = monotonic()
+        self.addrs = array.array('I', sorted(set(addresses)))
+        n = len(self.addrs)
+        self.nextProbe = array.array('I', [0]) * n # Seconds after self.start
+        self.misses = array.array('B', [0]) * n    # Consecutive probes not answered
+        self.flags = array.array('B', [0]) * n
 
-    toDo = [ socket.inet_ntoa(struct.pack("!L", ip)) 
-                   for ip in range(firstIp, lastIp+1) ]
+    def _index(self, packed):
+        i = bisect.bisect_left(self.addrs, packed)
+        if i < len(self.addrs) and self.addrs[i] == packed:
+            return i
+        return None
 
-    toDo += [ socket.gethostbyname(n) for n in site_config.extra_ips ]
+    def _now(self):
+        return int(monotonic() - self.start)
 
-    missing = []
-    contacted = []
-    arp = ARP()
+    def setPriority(self, addr):
+        '''Gives addr (packed) priority, and if it did not have it already,
+           makes it due to be probed straight away'''
+        i = self._index(addr)
+        if i != None and (self.flags[i] & self.PRIORITY) == 0:
+            self.flags[i] |= self.PRIORITY
+            self.nextProbe[i] = 0
 
-    print "ping.py: Address range", toDo[0], "...", toDo[-1]
+    def getDue(self):
+        '''Returns an array of the (packed) addresses due to be probed,
+           priority ones first'''
+        now = self._now()
+        (first, rest) = (array.array('I'), array.array('I'))
+        (addrs, nextProbe, flags) = (self.addrs, self.nextProbe, self.flags)
+        for i in xrange(len(addrs)):
+            if nextProbe[i] <= now and (flags[i] & self.LIVE) == 0:
+                if flags[i] & self.PRIORITY:
+                    first.append(addrs[i])
+                else:
+                    rest.append(addrs[i])
+        return first + rest
+
+    def setLost(self, addr):
+        '''Records that a device found at addr (packed) has stopped
+           answering, so that the address is looked at again from now on,
+           as if it had never replied'''
+        i = self._index(addr)
+        if i != None:
+            self.flags[i] &= ~self.LIVE
+            self.misses[i] = 0
+            self.nextProbe[i] = 0
+
+    def update(self, results):
+        '''Records the SweepResults of probing some of the addresses'''
+        now = self._now()
+        (addrs, delays) = (results.addrs, results.delays)
+        for j in xrange(len(results)):
+            i = self._index(addrs[j])
+            if i == None:
+                continue
+            if delays[j] == delays[j]:
+                self.flags[i] |= self.LIVE
+                self.misses[i] = 0
+                continue
+            self.misses[i] = min(self.misses[i] + 1, 255)
+            if self.flags[i] & self.PRIORITY:
+                limit = self.priorityInterval
+            else:
+                limit = self.maxInterval
+            interval = self.minInterval * (2 ** min(self.misses[i] - 1, 30))
+            self.nextProbe[i] = now + int(min(interval, limit))
+
+def recordSweep(kind, results):
+    stats.set('ping_sweep_probes{kind="%s"}' % kind, len(results))
+    stats.set('ping_sweep_replies{kind="%s"}' % kind, results.countReplies())
+
+def doPing(args, sock=None, arp=None, cycles=None, sockFactory=None):
+    '''Runs the pinger. sock and arp stand in for the raw ICMP socket and
+       the kernel's neighbour table (e.g. a simulated network; see
+       bench/simnet.py), and cycles limits the number of measurement
+       cycles; by default it runs for ever. With ping_shards set,
+       sockFactory makes each shard's socket instead of sock.'''
+    if site_config.ping_shards > 1:
+        p = ShardedPinger(site_config.ping_shards, timeout=site_config.ping_timeout_max,
+                          minTimeout=site_config.ping_timeout_min, sockFactory=sockFactory)
+    else:
+        p = Pinger(timeout=site_config.ping_timeout_max, sock=sock, minTimeout=site_config.ping_timeout_min)
+    firstIp = packAddress(site_config.first_ip)
+    lastIp = packAddress(site_config.last_ip)
+
+    # Addresses are kept packed (see packAddress()) throughout
+    toDo = array.array('I', xrange(firstIp, lastIp+1))
+
+    toDo += packAddresses([ socket.gethostbyname(n) for n in site_config.extra_ips ])
+
+    scheduler = ProbeScheduler(toDo, site_config.rescan_min_interval,
+                               site_config.rescan_max_interval, site_config.rescan_priority_interval)
+    for ip in site_config.known_ips.keys():
+        scheduler.setPriority(packAddress(ip))
+    contacted = array.array('I')
+    lastMac = {}  # Address -> MAC address when it last replied
+    lossRun = {}  # Address -> number of measurements lost in a row
+    if arp == None:
+        arp = ARP(subscribe=True)
+    notifier = pinglog.LogNotifier(site_config.notify_socket)
+    nextMeasure = time.time()
+    cycle = 0
+
+    print "ping.py: Address range", unpackAddress(toDo[0]), "...", unpackAddress(toDo[-1])
 
     while True:
         if len(toDo) > 0:
-            # Try to contact a few
-            resplist = p.ping(toDo[0:10])
-            toDo = toDo[10:]
-            missing += [ r.hostname for r in resplist if r.getDelay()==None ]
-            contacted += [ r.hostname for r in resplist if r.getDelay() != None ]
+            # Sweep the lot at a steady rate
+            with stats.timer('ping_sweep_seconds{kind="rescan"}'):
+                resplist = p.sweep(toDo, site_config.sweep_rate)
+            recordSweep("rescan", resplist)
+            toDo = array.array('I')
+            scheduler.update(resplist)
+            found = resplist.getReplied()
+            contacted += found
+            for addr in found:
+                lastMac[addr] = arp.getMacAddress(unpackAddress(addr))
             continue
-            
-        arp.reset()
+
+        # Measure on a fixed cadence, whatever the rescan took
+        now = time.time()
+        if nextMeasure > now:
+            time.sleep(nextMeasure - now)
+        while nextMeasure <= time.time():
+            nextMeasure += site_config.measure_interval
+
+        arp.poll()
         print "\nResults:"
-        lines = ""
-        (dayNow, timeNow) = time.strftime("%Y%m%d %H%M%S").split()
-        for host in contacted:
-            resp = p.ping([host]) [0]
-            if resp.getDelay() == None:
-                print "Lost", host
-                continue
-            mac = arp.getMacAddress(host)
-            line = ",".join([timeNow,host,mac,"%.1f" % (resp.getDelay()*1000)])
-            print line
-            lines += line + "\n"
-        if len(lines) > 0:
-            args={ 'date':dayNow, 'time':timeNow }
-            fname = site_config.input_file % args
-            with open(fname, "a") as f:
-                f.write(lines)
-            print "Wrote", fname
-        print "ping.py Rescanning",
-        toDo = missing
-        missing = []
-        
+        lines = {}
+        with stats.timer('ping_sweep_seconds{kind="measure"}'):
+            resplist = p.ping(contacted)
+        recordSweep("measure", resplist)
+        lostTime = time.time()
+        gone = set()
+        for i in xrange(len(resplist)):
+            addr = resplist.addrs[i]
+            hostname = unpackAddress(addr)
+            delay = resplist.getDelay(i)
+            if delay == None:
+                # Logged too, so that losses can be counted, against the
+                # device which last answered there: by now the ARP table
+                # may have forgotten it
+                print "Lost", hostname
+                mac = lastMac.get(addr, "-")
+                (receiveTime, delayMs) = (lostTime, None)
+                lossRun[addr] = lossRun.get(addr, 0) + 1
+                if lossRun[addr] >= site_config.lost_limit:
+                    gone.add(addr)
+            else:
+                mac = arp.getMacAddress(hostname)
+                lastMac[addr] = mac
+                lossRun.pop(addr, None)
+                (receiveTime, delayMs) = (resplist.getReceiveTime(i), delay*1000)
+                print pinglog.formatCsv(receiveTime, hostname, mac, delayMs)
+            dayNow = time.strftime("%Y%m%d", time.localtime(receiveTime))
+            lines.setdefault(dayNow, []).append(
+                pinglog.formatRecord(receiveTime, hostname, mac, delayMs) )
+        with stats.timer("ping_log_write_seconds"):
+            for dayNow in sorted(lines.keys()):
+                fname = pinglog.logFileName(dayNow)
+                with open(fname, "ab") as f:
+                    f.write("".join(lines[dayNow]))
+                print "Wrote", fname
+                notifier.notify(fname)
+        if len(gone) > 0:
+            # Stop measuring devices which seem to have gone, and look
+            # for them (or their successors) in the rescans instead
+            print "ping.py Gone:", " ".join([ unpackAddress(addr) for addr in sorted(gone) ])
+            contacted = array.array('I', [ addr for addr in contacted if addr not in gone ])
+            for addr in gone:
+                scheduler.setLost(addr)
+                del lastMac[addr]
+                del lossRun[addr]
+        stats.set("ping_last_cycle_timestamp", time.time())
+        metricsFile = metrics.getFileName("ping")
+        if metricsFile != None:
+            stats.writeTextfile(metricsFile)
+        cycle += 1
+        if cycles != None and cycle >= cycles:
+            if site_config.ping_shards > 1:
+                p.close()
+            return
+        # Anything the neighbour table knows about is worth looking for
+        for ip in arp.getNeighbours().keys():
+            scheduler.setPriority(packAddress(ip))
+        toDo = scheduler.getDue()
+        print "ping.py Rescanning", len(toDo), "addresses",
+
 
 if __name__ == '__main__':
     doPing(sys.argv[1:])
@@ -10,10 +10,39 @@ import sys
 import os
 import time
 import glob
-import pickle
+import multiprocessing
+import mmap
+import array
+import struct
 import site_config
+import pinglog
+import metrics
 
-from mkgraph import StdColors, Graph, TimeGraph, TimeSeries, LinearYAxis, LogYAxis
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mkgraph import StdColors, Graph, TimeGraph, TimeSeries, LinearYAxis, LogYAxis, loadTrueTypeFont, replaceFile
+from mkgraph import GraphAtlas, getPalette, imageToBytes
+from mkgraph import HistoryGraph, WeekGraph, MonthGraph, YearGraph
+from rollup import RollupStore
+from lastseen import LastSeenStore
+
+NAN = float("nan")
+
+stats = metrics.Metrics()
+stats.define("pinggraph_ingest_rows_total", "counter", "Log records read")
+stats.define("pinggraph_ingest_rows", "gauge", "Log records read in the last pass")
+stats.define("pinggraph_ingest_seconds", "gauge", "Time taken to read the log in the last pass")
+stats.define("pinggraph_ingest_rows_per_second", "gauge", "Rate at which the log was read in the last pass")
+stats.define("pinggraph_graphs_total", "counter", "Graphs drawn")
+stats.define("pinggraph_render_seconds_total", "counter", "Time spent drawing graphs")
+stats.define("pinggraph_encode_seconds_total", "counter", "Time spent compressing and writing graphs")
+stats.define("pinggraph_graphs", "gauge", "Graphs drawn in the last pass which drew any")
+stats.define("pinggraph_render_seconds_per_graph", "gauge", "Average time to draw a graph, in the last pass which drew any")
+stats.define("pinggraph_encode_seconds_per_graph", "gauge", "Average time to compress and write a graph, in the last pass which drew any")
+stats.define("pinggraph_page_write_seconds", "gauge", "Time taken to write the last page")
 
 def getTargetName(ip,mac,default=None):
     if ip in site_config.known_ips:
@@ -22,41 +51,475 @@ def getTargetName(ip,mac,default=None):
         return site_config.known_macs[mac]
     return default
       
-def getDataSeries(inputFile, lastSeen):
-    allTargets = {}
-    with open(inputFile, "r") as infile:
-        for line in infile:
-            (timestr,ip,mac,delay) = line.rstrip().split(",")
+class LogIngest:
+    '''Holds the TimeSeries for one day's log file between refreshes, and
+       parses only the complete lines appended since the last update()'''
+    def __init__(self, rollups=None):
+        self.rollups = rollups
+        self.newlySeen = {} # (mac, name or "") -> (first, last, ip), since popSeen()
+        self.reset(None)
+
+    def reset(self, inputFile, date=None):
+        self.inputFile = inputFile
+        self.date = date
+        self.offset = 0
+        self.allTargets = {}
+        self.seenToday = {}
+        self.names = {}
+
+    def popSeen(self):
+        '''Returns the devices which have replied since the last call, as
+           (mac, name or "") -> (times first and last seen, IP address)'''
+        (seen, self.newlySeen) = (self.newlySeen, {})
+        return seen
+
+    def _addRollups(self, points):
+        '''Adds points, target -> (times, delays with NaN for lost), to the
+           rollups, a target at a time'''
+        for (target, (times, delays)) in points.iteritems():
+            self.rollups.addColumn(target, times, delays)
+
+    def _addSeen(self, target, first, last):
+        (ip, mac) = target.split("/")
+        key = (mac, self.names[target] or "")
+        seen = self.newlySeen.get(key)
+        if seen == None:
+            self.newlySeen[key] = (first, last, ip)
+        elif seen[1] <= last:
+            self.newlySeen[key] = (min(seen[0], first), last, ip)
+        else:
+            self.newlySeen[key] = (min(seen[0], first), seen[1], seen[2])
+
+    def update(self, inputFile, date=None):
+        '''Reads new data from inputFile, starting afresh if it is a
+           different file from last time (e.g. after midnight) or has
+           shrunk. Returns the number of lines read. New data is also
+           added to the rollups, if any; for that, the file's date (as
+           YYYYMMDD) must be given.'''
+        nlines = 0
+        if inputFile != self.inputFile:
+            # Finish the previous file first, so that whatever was added
+            # to it since the last update still reaches the rollups and
+            # the last-seen times
+            if self.inputFile != None and os.path.isfile(self.inputFile):
+                nlines = self._read()
+            self.reset(inputFile, date)
+        elif os.path.getsize(inputFile) < self.offset:
+            self.reset(inputFile, date)
+        return nlines + self._read()
+
+    def _read(self):
+        '''Reads what has been added to self.inputFile since last time'''
+        (inputFile, date) = (self.inputFile, self.date)
+        rollups = self.rollups
+        if date != None:
+            midnight = time.mktime(time.strptime(date, "%Y%m%d"))
+        else:
+            midnight = localMidnight(time.time())
+            rollups = None
+        with open(inputFile, "r") as infile:
+            infile.seek(self.offset)
+            data = infile.read()
+        # Leave any partly-written last line for next time
+        end = data.rfind("\n") + 1
+        self.offset += end
+        lines = data[:end].splitlines()
+        (earliest, latest) = ({}, {})
+        points = {} # For the rollups
+        for line in lines:
+            (timestr,ip,mac,delay) = line.split(",")
             target = ip+"/"+mac
-            series = allTargets.get(target)
+            series = self.allTargets.get(target)
             if series is None:
                 series = TimeSeries()
-                allTargets[target] = series
+                self.allTargets[target] = series
+                self.names[target] = getTargetName(ip,mac)
+            if rollups != None:
+                (times, delays) = points.setdefault(target, ([], []))
+                times.append(getTimestamp(midnight, timestr))
+                delays.append(NAN if delay == "-" else float(delay))
+            if delay == "-":
+                series.addLoss(timestr)
+                continue
             series.addPoint(timestr, delay)
-            name = getTargetName(ip,mac)
+            # Assume last one is at end of file!
+            latest[target] = timestr
+            earliest.setdefault(target, timestr)
+        for (target, timestr) in latest.iteritems():
+            name = self.names[target]
             if name != None:
-                # Assume last one is at end of file!
-                lastSeen[name]=timestr
-    return allTargets
+                self.seenToday[name] = timestr
+            self._addSeen(target, getTimestamp(midnight, earliest[target]), getTimestamp(midnight, timestr))
+        if rollups != None:
+            self._addRollups(points)
+        return len(lines)
+
+def getTimestamp(midnight, timestr):
+    '''Returns the time of a log line's HHMMSS, on the day starting at midnight'''
+    return midnight + int(timestr[0:2])*3600 + int(timestr[2:4])*60 + int(timestr[4:6])
+
+def localMidnight(timestamp):
+    t = time.localtime(timestamp)
+    return time.mktime( (t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1) )
+
+class BinaryLogIngest(LogIngest):
+    '''LogIngest for binary logs (see pinglog.py). The file is memory-mapped
+       and, if numpy is available, each device's new records are added to
+       its series a column at a time.'''
+    def reset(self, inputFile, date=None):
+        LogIngest.reset(self, inputFile, date)
+        self.midnight = None
+        self.devices = {} # (ip, macLo, macHi) -> (series, name)
+
+    def _read(self):
+        # Leave any partly-written last record for next time
+        nrecs = (os.path.getsize(self.inputFile) - self.offset) // pinglog.RECORD.size
+        if nrecs == 0:
+            return 0
+        with open(self.inputFile, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if numpy != None:
+                self._ingestNumpy(mm, nrecs)
+            else:
+                self._ingest(mm, nrecs)
+        finally:
+            mm.close()
+        self.offset += nrecs * pinglog.RECORD.size
+        return nrecs
+
+    def _getDevice(self, key):
+        device = self.devices.get(key)
+        if device is None:
+            (ip, macLo, macHi) = key
+            ip = pinglog.unpackIp(ip)
+            mac = pinglog.unpackMac(struct.pack("<IH", macLo, macHi))
+            target = ip+"/"+mac
+            series = self.allTargets.get(target)
+            if series is None:
+                series = TimeSeries()
+                self.allTargets[target] = series
+                self.names[target] = getTargetName(ip,mac)
+            device = (series, self.names[target], target)
+            self.devices[key] = device
+        return device
+
+    def _seen(self, target, name, first, last):
+        if name != None:
+            self.seenToday[name] = time.strftime("%H%M%S", time.localtime(last))
+        self._addSeen(target, first, last)
+
+    def _ingestNumpy(self, mm, nrecs):
+        words = numpy.frombuffer(mm, dtype="<u4", count=nrecs*4, offset=self.offset).reshape(nrecs, 4)
+        if self.midnight == None:
+            self.midnight = localMidnight(int(words[0,0]))
+        # Give each (IP, MAC) pair a distinct number, from the IP and the
+        # MAC's index, then sort the records by it, keeping each device's
+        # in time order, so that each device's records are one run of the
+        # columns
+        macs = words[:,2].astype(numpy.uint64) | ((words[:,3] & 0xFFFF).astype(numpy.uint64) << 32)
+        macIds = numpy.unique(macs, return_inverse=True)[1]
+        cells = (macIds.astype(numpy.uint64) << 32) | words[:,1]
+        order = numpy.argsort(cells, kind="mergesort")
+        cells = cells[order]
+        starts = numpy.flatnonzero(numpy.concatenate( ([True], cells[1:] != cells[:-1]) ))
+        ends = numpy.append(starts[1:], nrecs)
+        times = words[order,0]
+        tenths = words[order,3] >> 16
+        delays = numpy.where(tenths == pinglog.LOST, numpy.nan, tenths / 10.0)
+
+        for (start, end) in zip(starts.tolist(), ends.tolist()):
+            first = words[order[start]]
+            (series, name, target) = self._getDevice( (int(first[1]), int(first[2]), int(first[3]) & 0xFFFF) )
+            (t, d) = (times[start:end], delays[start:end])
+            buckets = ((t - self.midnight) * (series.countsPerHour / 3600.0)).astype(int)
+            inDay = (buckets >= 0) & (buckets < series.length)
+            series.addColumn(buckets[inDay], d[inDay])
+            if self.rollups != None:
+                self.rollups.addColumn(target, t, d)
+            replied = t[tenths[start:end] != pinglog.LOST]
+            if len(replied) > 0:
+                self._seen(target, name, int(replied.min()), int(replied.max()))
+
+    def _ingest(self, mm, nrecs):
+        words = array.array('I')
+        words.fromstring(mm[self.offset : self.offset + nrecs*pinglog.RECORD.size])
+        if self.midnight == None:
+            self.midnight = localMidnight(words[0])
+        proto = TimeSeries()
+        scale = proto.countsPerHour / 3600.0
+        seen = {} # target -> (first, last) time replied
+        points = {} # For the rollups
+        for i in xrange(0, len(words), 4):
+            (series, name, target) = self._getDevice( (words[i+1], words[i+2], words[i+3] & 0xFFFF) )
+            bucket = int((words[i] - self.midnight) * scale)
+            tenths = words[i+3] >> 16
+            if tenths == pinglog.LOST:
+                datum = None
+            else:
+                datum = tenths / 10.0
+                (first, last) = seen.get(target, (words[i], words[i]))
+                seen[target] = (min(first, words[i]), max(last, words[i]))
+            if self.rollups != None:
+                (times, delays) = points.setdefault(target, ([], []))
+                times.append(words[i])
+                delays.append(NAN if datum == None else datum)
+            if 0 <= bucket < proto.length:
+                series.addPointAt(bucket, datum)
+        for (target, (first, last)) in seen.iteritems():
+            self._seen(target, self.names[target], first, last)
+        if self.rollups != None:
+            self._addRollups(points)
+
+def makeIngest(rollups=None):
+    if pinglog.isBinary():
+        return BinaryLogIngest(rollups)
+    return LogIngest(rollups)
+
+def recordIngest(nlines, elapsed):
+    stats.inc("pinggraph_ingest_rows_total", nlines)
+    stats.set("pinggraph_ingest_rows", nlines)
+    stats.set("pinggraph_ingest_rows_per_second", nlines / max(elapsed, 1e-6))
+
+def getDataSeries(inputFile, lastSeen):
+    ingest = LogIngest()
+    ingest.update(inputFile)
+    lastSeen.update(ingest.seenToday)
+    return ingest.allTargets
     
 
   
-def writeGraph(target, series, outputFile):
-    font = site_config.graph_font
-
-    graph = ( TimeGraph( yAxis=LogYAxis(maxVal=1000.0, yPixPerDecade=50) )
-              .hasOrigin(45, 220)
-              .hasColors( StdColors )
-              .hasStdDrawObject(640, 240)
-              .hasTrueTypeFont( font, size=10 )
-              .hasTitle( target +" generated at " + time.strftime("%d/%m/%Y %H:%M:%S") )
-              .drawAxes()
-              .plotSeriesAsBars(series, StdColors.data1)
-              .drawTitle()
-              .saveToDisk(outputFile)
-            )
-              
+# Graph layout
+graphSize = (640, 240)
+graphOrigin = (45, 220)
+graphYAxis = { 'maxVal':1000.0, 'yPixPerDecade':50 }
+graphFontSize = 10
+
+def getRenderConfig():
+    '''Returns everything apart from the data which affects a graph's appearance'''
+    return (site_config.graph_font, graphFontSize, graphSize, graphOrigin,
+            tuple(sorted(graphYAxis.items())))
+
+def setupGraph(graph, title, font=None, svg=False):
+    ( graph.hasOrigin(*graphOrigin)
+           .hasColors( StdColors )
+           .hasTitle(title)
+    )
+    if svg:
+        graph.hasSvgDrawObject(*graphSize)
+    else:
+        graph.hasStdDrawObject(*graphSize)
+    if font != None:
+        graph.hasTextFont(font)
+    else:
+        graph.hasTrueTypeFont( site_config.graph_font, size=graphFontSize )
+    return graph
+
+def getGraphFileName(idx):
+    return "ping-%05d.png" % idx
+
+def writeGraph(target, series, outputFile, font=None):
+    start = time.time()
+    return saveGraph(drawGraph(target, series, font), outputFile, start)
+
+def drawGraph(target, series, font=None, svg=False):
+    graph = TimeGraph( yAxis=LogYAxis(**graphYAxis) )
+    ( setupGraph(graph, target +" generated at " + time.strftime("%d/%m/%Y %H:%M:%S"), font, svg)
+           .drawAxes()
+           .plotRangeAsBand(series, StdColors.band)
+           .plotSeriesAsBars(series, StdColors.data1)
+           .plotPercentileAsLine(series, StdColors.percentile, 0.95)
+           .plotLossMarkers(series, StdColors.loss)
+           .drawTitle()
+    )
+    return graph
+
+def saveGraph(graph, outputFile, start):
+    '''Writes out a graph whose drawing began at time start. Returns the
+       time taken to (render, encode) it, for the metrics.'''
+    drawn = time.time()
+    graph.saveToDisk(outputFile)
     print "Wrote", outputFile
+    return (drawn - start, time.time() - drawn)
+
+# Graph rendering in worker processes. Each worker loads the font once,
+# and is sent series in compact form.
+workerFont = None
+
+def initWorker(fontfile, size):
+    global workerFont
+    workerFont = loadTrueTypeFont(fontfile, size=size)
+
+def writeCompactGraph(job):
+    (target, compact, outputFile) = job
+    return writeGraph(target, TimeSeries.fromCompact(compact), outputFile, workerFont)
+
+def writeGraphs(jobs, pool=None):
+    '''Writes a graph for each (target, series, outputFile) in jobs, using
+       pool if given. Returns when all of them are on disk, with a list of
+       the time taken to (render, encode) each.'''
+    if pool == None:
+        return [ writeGraph(target, series, outputFile) for (target, series, outputFile) in jobs ]
+    return pool.map(writeCompactGraph, [ (target, series.toCompact(), outputFile)
+                                           for (target, series, outputFile) in jobs ])
+
+def recordGraphTimings(timings):
+    '''Adds a list of (render, encode) times to the metrics'''
+    if len(timings) == 0:
+        return
+    render = sum([ r for (r, e) in timings ])
+    encode = sum([ e for (r, e) in timings ])
+    stats.inc("pinggraph_graphs_total", len(timings))
+    stats.inc("pinggraph_render_seconds_total", render)
+    stats.inc("pinggraph_encode_seconds_total", encode)
+    stats.set("pinggraph_graphs", len(timings))
+    stats.set("pinggraph_render_seconds_per_graph", render / len(timings))
+    stats.set("pinggraph_encode_seconds_per_graph", encode / len(timings))
+
+# Longer-term graphs, drawn from the rollups
+historyGraphs = { 'week':WeekGraph, 'month':MonthGraph, 'year':YearGraph }
+
+def getHistoryFileName(fname, kind):
+    (root, ext) = os.path.splitext(fname)
+    return "%s-%s%s" % (root, kind, ext)
+
+def makeHistoryGraph(kind, endTime):
+    return historyGraphs[kind](endTime, yAxis=LogYAxis(**graphYAxis))
+
+def makeRangeGraph(startTime, endTime):
+    '''Returns a HistoryGraph from startTime to endTime, for any range'''
+    span = endTime - startTime
+    if span <= 2*86400:
+        labelFormat = "%H:%M"
+    elif span <= 120*86400:
+        labelFormat = "%d/%m"
+    else:
+        labelFormat = "%b"
+    return HistoryGraph(endTime, span / 12.0, labelFormat, xUnits=12, xPixPerUnit=44, yAxis=LogYAxis(**graphYAxis))
+
+def getHistoryDrawn(target, kind, rollups, endTime):
+    '''Returns what a history graph drawn now would show; it needs
+       redrawing when this changes, i.e. once there is another pixel's
+       worth of data'''
+    graph = makeHistoryGraph(kind, endTime)
+    pixel = (endTime - graph.getStartTime()) / graph.xTotal
+    return (target, endTime, int(rollups.getLastUpdate(target) // pixel), getRenderConfig())
+
+def writeHistoryGraph(target, kind, rollups, outputFile, endTime):
+    start = time.time()
+    graph = drawRollupGraph(target, makeHistoryGraph(kind, endTime), rollups, "past " + kind)
+    return saveGraph(graph, outputFile, start)
+
+def drawRollupGraph(target, graph, rollups, description, svg=False):
+    '''Draws the rollups for target over the range of a HistoryGraph'''
+    series = rollups.getSeries(target, graph.getStartTime(), graph.endTime, graph.xTotal)
+    ( setupGraph(graph, "%s %s, generated at %s" % (target, description, time.strftime("%d/%m/%Y %H:%M:%S")), svg=svg)
+           .drawAxes()
+           .plotRangeAsBand(series, StdColors.band)
+           .plotSeriesAsBars(series, StdColors.data1)
+           .plotLossMarkers(series, StdColors.loss)
+           .drawTitle()
+    )
+    return graph
+
+# Ways of putting the graphs on the page; see site_config.graph_output
+atlasPalette = getPalette(StdColors)
+
+def encodeGraph(graph, output):
+    '''Returns a drawn graph in the form "atlas" or "svg" output keeps it'''
+    if output == "svg":
+        return graph.getSvgData()
+    return imageToBytes(graph.getPaletteImage(atlasPalette))
+
+def drawGraphData(target, series, output, font=None):
+    '''Returns ((render, encode) times, data) for a graph for output'''
+    start = time.time()
+    graph = drawGraph(target, series, font, svg=(output == "svg"))
+    drawn = time.time()
+    data = encodeGraph(graph, output)
+    return ((drawn - start, time.time() - drawn), data)
+
+def drawCompactGraphData(job):
+    (target, compact, output) = job
+    return drawGraphData(target, TimeSeries.fromCompact(compact), output, workerFont)
+
+class GraphFiles:
+    '''Writes each graph to its own PNG file, which the page links to'''
+    def drawGraphs(self, jobs, pool=None):
+        '''Draws a graph for each (target, series, fname) in jobs, using
+           pool if given. Returns the time taken to (render, encode) each.'''
+        return writeGraphs([ (target, series, os.path.join(site_config.output_path, fname))
+                             for (target, series, fname) in jobs ], pool)
+
+    def drawHistoryGraph(self, target, kind, rollups, fname, endTime):
+        return writeHistoryGraph(target, kind, rollups, os.path.join(site_config.output_path, fname), endTime)
+
+    def finish(self):
+        '''Called once each pass's graphs are drawn, before the page is written'''
+        pass
+
+    def getImageHtml(self, fname):
+        return '<img src="%s">' % fname
+
+class GraphData(GraphFiles):
+    '''Base for outputs which keep the graphs in memory, as store()d by
+       the drawing functions, and write them out in finish()'''
+    def __init__(self, output):
+        self.output = output
+
+    def drawGraphs(self, jobs, pool=None):
+        if pool == None:
+            results = [ drawGraphData(target, series, self.output) for (target, series, fname) in jobs ]
+        else:
+            results = pool.map(drawCompactGraphData, [ (target, series.toCompact(), self.output)
+                                                      for (target, series, fname) in jobs ])
+        for ((target, series, fname), (timing, data)) in zip(jobs, results):
+            self.store(fname, data)
+        return [ timing for (timing, data) in results ]
+
+    def drawHistoryGraph(self, target, kind, rollups, fname, endTime):
+        start = time.time()
+        graph = drawRollupGraph(target, makeHistoryGraph(kind, endTime), rollups, "past " + kind,
+                                svg=(self.output == "svg"))
+        drawn = time.time()
+        self.store(fname, encodeGraph(graph, self.output))
+        return (drawn - start, time.time() - drawn)
+
+class GraphAtlasOutput(GraphData):
+    '''Puts the graphs in a few palette images (see mkgraph.GraphAtlas),
+       and each in its place on the page with CSS'''
+    sheetName = "atlas-%03d.png"
+
+    def __init__(self):
+        GraphData.__init__(self, "atlas")
+        self.atlas = GraphAtlas(graphSize, atlasPalette)
+        self.slots = {} # File name the graph would have had -> slot in atlas
+
+    def store(self, fname, data):
+        slot = self.slots.setdefault(fname, len(self.slots))
+        self.atlas.setGraph(slot, data)
+
+    def finish(self):
+        self.atlas.save(os.path.join(site_config.output_path, self.sheetName))
+
+    def getImageHtml(self, fname):
+        if fname not in self.slots:
+            return ""
+        return '<span style="%s"></span>' % self.atlas.getStyle(self.slots[fname], self.sheetName)
+
+class SvgOutput(GraphData):
+    '''Puts each graph in the page itself, as SVG'''
+    def __init__(self):
+        GraphData.__init__(self, "svg")
+        self.svgs = {} # File name the graph would have had -> SVG
+
+    def store(self, fname, data):
+        self.svgs[fname] = data
+
+    def getImageHtml(self, fname):
+        return self.svgs.get(fname, "")
+
+graphOutputs = { 'png':GraphFiles, 'atlas':GraphAtlasOutput, 'svg':SvgOutput }
 
 def cmpCaseless(first, second):
     return cmp(first.lower(), second.lower())
@@ -74,8 +537,44 @@ def lastSeenColour(name, lastSeen):
     else:
         return '"red"'
 
-def writeHtmlPage( filename, outlist, lastSeen ):
+def getMetricsFooter():
+    '''Returns a line summarising how long things took, from our metrics
+       and ping.py's'''
+    parts = []
+    pingFile = metrics.getFileName("ping")
+    if pingFile != None:
+        pingStats = metrics.readTextfile(pingFile)
+        measured = pingStats.get('ping_sweep_seconds{kind="measure"}')
+        if measured != None:
+            parts.append("ping %d/%d replied in %.1fs, %d stray" %
+                         (pingStats.get('ping_sweep_replies{kind="measure"}', 0),
+                          pingStats.get('ping_sweep_probes{kind="measure"}', 0),
+                          measured, pingStats.get("ping_stray_replies_total", 0)))
+    if stats.get("pinggraph_ingest_seconds") != None:
+        parts.append("read %d rows at %d rows/s" % (stats.get("pinggraph_ingest_rows"),
+                                                     stats.get("pinggraph_ingest_rows_per_second")))
+    if stats.get("pinggraph_graphs") != None:
+        parts.append("%d graphs at %.1fms render + %.1fms encode each" %
+                     (stats.get("pinggraph_graphs"),
+                      stats.get("pinggraph_render_seconds_per_graph") * 1000.0,
+                      stats.get("pinggraph_encode_seconds_per_graph") * 1000.0))
+    if stats.get("pinggraph_page_write_seconds") != None:
+        parts.append("last page %.1fms" % (stats.get("pinggraph_page_write_seconds") * 1000.0))
+    return "; ".join(parts)
+
+def writeHtmlPage( filename, outlist, lastSeen, historyKinds=[], footer=None, imageHtml=None ):
     print "Writing page", filename
+    page = getHtmlPage(outlist, lastSeen, historyKinds, footer, imageHtml)
+    def writer(tempname):
+        with open(tempname, "w") as f:
+            f.write(page)
+    replaceFile(filename, writer)
+
+def getHtmlPage( outlist, lastSeen, historyKinds=[], footer=None, imageHtml=None ):
+    '''imageHtml(fname), if given, returns what shows the graph which would
+       be in fname; by default, an img tag'''
+    if imageHtml == None:
+        imageHtml = GraphFiles().getImageHtml
     lines = [
         "<!DOCTYPE html>",
         "<html>",
@@ -116,19 +615,23 @@ def writeHtmlPage( filename, outlist, lastSeen ):
         name = getTargetName(ip,mac,default=mac)
         lines += [
             '<h2>%s (%s)</h2>' % (ip,name),
-            '<p><img src="%s"></p>' % fname
+            '<p>%s</p>' % imageHtml(fname)
         ]
+        for kind in historyKinds:
+            lines += [ '<p>%s</p>' % imageHtml(getHistoryFileName(fname, kind)) ]
 
     lines += [        
         "<hr>",
         "<p><i>Page generated at " + time.asctime() + "</i></p>",
+    ]
+    if footer:
+        lines += [ "<p><small>" + footer + "</small></p>" ]
+    lines += [
         "</body>",
         "</html>",
         ""
     ]
-
-    with open(filename, "w") as f:
-        f.write("\n".join(lines))
+    return "\n".join(lines)
 
 def cmpByIp(first,second):
     (ip1,mac1) = first.split("/")
@@ -137,43 +640,89 @@ def cmpByIp(first,second):
     nip2 = [ int(x) for x in ip2.split(".") ]
     return cmp( nip1 + [mac1], nip2 + [mac2] )
 
-def updateLastSeen(seenToday, dateNow):
-    try:
-        with open(site_config.last_seen_file, "r") as f:
-            lastSeen = pickle.load(f)
-    except IOError as e:
-        print "Cannot load", site_config.last_seen_file, ", error is", str(e)
-        lastSeen = {}
-    for (name, timestr) in seenToday.iteritems():
-        lastSeen[name] = time.strptime( dateNow + timestr, "%Y%m%d%H%M%S" )
-    with open(site_config.last_seen_file, "w") as f:
-        pickle.dump(lastSeen, f)
-    print "Updated", site_config.last_seen_file
-    return lastSeen
+def openLastSeen():
+    '''Opens the last-seen database, bringing in the old pickled
+       last-seen file (if any) when the database is first made'''
+    store = LastSeenStore(site_config.last_seen_db)
+    oldFile = getattr(site_config, "last_seen_file", None)
+    if store.isNew and oldFile != None and os.path.isfile(oldFile):
+        print "Imported", store.importPickle(oldFile), "names from", oldFile
+    return store
 
 if __name__ == '__main__':
    
+    rollups = None
+    historyKinds = []
+    if site_config.rollup_path != None:
+        rollups = RollupStore(site_config.rollup_path)
+        historyKinds = site_config.history_graphs
+    if sys.argv[1:2] == ["--serve"]:
+        import graphserver
+        port = site_config.serve_port
+        if len(sys.argv) > 2:
+            port = int(sys.argv[2])
+        graphserver.serve(port, rollups, historyKinds)
+        sys.exit(0)
+    ingest = makeIngest(rollups)
+    lastSeenStore = openLastSeen()
+    output = graphOutputs[site_config.graph_output]()
+    rendered = {} # Output file -> what was last drawn in it
+    watcher = pinglog.LogWatcher(site_config.notify_socket)
+    pool = None
+    if site_config.graph_workers > 0:
+        pool = multiprocessing.Pool(site_config.graph_workers, initWorker,
+                                    (site_config.graph_font, graphFontSize))
     while True:
         args = { 'date' : time.strftime("%Y%m%d") }
-        inputFile = site_config.input_file % args
+        inputFile = pinglog.logFileName(args['date'])
         
         if not os.path.isfile(inputFile):
             print sys.argv[0], ': No files matching', inputFile
-            time.sleep(10)
+            watcher.wait(10)
             continue
 
         print "Reading", inputFile
-        seenToday = {}
-        allData = getDataSeries(inputFile, seenToday)
+        with stats.timer("pinggraph_ingest_seconds") as t:
+            nlines = ingest.update(inputFile, args['date'])
+        print "Read", nlines, "new lines"
+        recordIngest(nlines, t.elapsed)
+        allData = ingest.allTargets
         targets = allData.keys()
         targets.sort(cmpByIp)
         outlist = []
+        jobs = []
+        redrawn = {}
         for idx in range(len(targets)):
-            fname = "ping-%05d.png" % idx
+            fname = getGraphFileName(idx)
             target = targets[idx]
-            writeGraph( target, allData[target], os.path.join(site_config.output_path,fname) )
+            series = allData[target]
+            # Only redraw if something has changed
+            drawn = (target, series.generation, getRenderConfig())
+            if rendered.get(fname) != drawn:
+                jobs.append( (target, series, fname) )
+                redrawn[fname] = drawn
             outlist += [ (target, fname) ]
-        lastSeen = updateLastSeen(seenToday, args['date'])
-        writeHtmlPage( os.path.join(site_config.output_path, site_config.page_name), outlist, lastSeen )
-        time.sleep(site_config.graph_interval)
+        # Every graph must be in place before the page refers to it
+        timings = output.drawGraphs(jobs, pool)
+        rendered.update(redrawn)
+        if len(historyKinds) > 0:
+            endTime = localMidnight(time.time()) + 24*3600
+            for (target, fname) in outlist:
+                for kind in historyKinds:
+                    hname = getHistoryFileName(fname, kind)
+                    drawn = getHistoryDrawn(target, kind, rollups, endTime)
+                    if rendered.get(hname) != drawn:
+                        timings.append( output.drawHistoryGraph(target, kind, rollups, hname, endTime) )
+                        rendered[hname] = drawn
+        output.finish()
+        recordGraphTimings(timings)
+        lastSeenStore.update(ingest.popSeen())
+        lastSeen = lastSeenStore.getLastSeen()
+        with stats.timer("pinggraph_page_write_seconds"):
+            writeHtmlPage( os.path.join(site_config.output_path, site_config.page_name), outlist, lastSeen, historyKinds,
+                           getMetricsFooter(), output.getImageHtml )
+        metricsFile = metrics.getFileName("pinggraph")
+        if metricsFile != None:
+            stats.writeTextfile(metricsFile)
+        watcher.wait(site_config.graph_interval)
 
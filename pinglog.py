@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Binary log format for ping.py results, as an alternative to the .csv
+# log, plus a tool to convert logs between the two formats.
+#
+# A binary log is a sequence of 16-byte little-endian records:
+#   u32  time the reply was received, in seconds since the epoch
+#   u32  IPv4 address, as a number (192.168.1.1 is 0xC0A80101)
+#   6 bytes MAC address, all zeros if not known
+#   u16  round-trip time in tenths of a millisecond, or 0xFFFF if the
+#        ping was lost
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import sys
+import os
+import re
+import time
+import errno
+import select
+import struct
+import socket
+import site_config
+
+RECORD = struct.Struct("<II6sH")
+NO_MAC = "\x00" * 6
+MAX_DELAY = 0xFFFE # 6553.4ms
+LOST = 0xFFFF
+
+def isBinary():
+    return site_config.log_format == "binary"
+
+def logFileName(date):
+    '''Name of the log for date (as YYYYMMDD) in the configured format'''
+    args = { 'date':date }
+    if isBinary():
+        return site_config.binary_input_file % args
+    return site_config.input_file % args
+
+def packIp(ip):
+    return struct.unpack("!L", socket.inet_aton(ip)) [0]
+
+def unpackIp(number):
+    return socket.inet_ntoa(struct.pack("!L", number))
+
+def packMac(mac):
+    if mac == "-":
+        return NO_MAC
+    return "".join([ chr(int(x, 16)) for x in mac.split(":") ])
+
+def unpackMac(raw):
+    if raw == NO_MAC:
+        return "-"
+    return ":".join([ "%02x" % ord(c) for c in raw ])
+
+# In all of these, delayMs is None for a lost ping
+
+def packRecord(timestamp, ip, mac, delayMs):
+    if delayMs is None:
+        tenths = LOST
+    else:
+        tenths = min(int(round(delayMs * 10.0)), MAX_DELAY)
+    return RECORD.pack(int(timestamp), packIp(ip), packMac(mac), tenths)
+
+def unpackRecord(data, offset=0):
+    '''Returns (timestamp, ip, mac, delayMs)'''
+    (timestamp, ip, mac, tenths) = RECORD.unpack_from(data, offset)
+    if tenths == LOST:
+        delayMs = None
+    else:
+        delayMs = tenths / 10.0
+    return (timestamp, unpackIp(ip), unpackMac(mac), delayMs)
+
+def formatCsv(timestamp, ip, mac, delayMs):
+    if delayMs is None:
+        delay = "-"
+    else:
+        delay = "%.1f" % delayMs
+    return ",".join([ time.strftime("%H%M%S", time.localtime(timestamp)), ip, mac, delay ])
+
+def formatRecord(timestamp, ip, mac, delayMs):
+    '''Returns a log record in the configured format'''
+    if isBinary():
+        return packRecord(timestamp, ip, mac, delayMs)
+    return formatCsv(timestamp, ip, mac, delayMs) + "\n"
+
+#------------------------------------------------------------------------------
+# Optional notification, over a Unix datagram socket, that ping.py has
+# appended to the log. The log itself is still the record; this just lets
+# pinggraph.py read it straight away instead of polling.
+
+class LogNotifier:
+    '''Used by ping.py to say it has written to a log'''
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        if path != None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(0)
+
+    def notify(self, logFile):
+        if self.sock == None:
+            return
+        try:
+            self.sock.sendto(logFile, self.path)
+        except socket.error:
+            pass # Nobody listening, or they are behind; the log has it anyway
+
+class LogWatcher:
+    '''Used by pinggraph.py to wait for ping.py to write to a log'''
+    def __init__(self, path):
+        self.sock = None
+        if path != None:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(path)
+            self.sock.setblocking(0)
+
+    def wait(self, timeout):
+        '''Waits up to timeout seconds, or until the log is written to.
+           Returns the names of the logs written to, if known.'''
+        if self.sock == None:
+            time.sleep(timeout)
+            return []
+        select.select([self.sock], [], [], timeout)
+        written = []
+        while True:
+            try:
+                written.append(self.sock.recv(4096))
+            except socket.error:
+                return written
+
+#------------------------------------------------------------------------------
+
+def binaryToCsv(binFile, csvFile):
+    with open(binFile, "rb") as f:
+        data = f.read()
+    nrecs = len(data) // RECORD.size
+    with open(csvFile, "w") as f:
+        for i in xrange(nrecs):
+            f.write(formatCsv(*unpackRecord(data, i * RECORD.size)) + "\n")
+    return nrecs
+
+def csvToBinary(csvFile, date, binFile):
+    nrecs = 0
+    with open(csvFile, "r") as inf:
+        with open(binFile, "wb") as outf:
+            for line in inf:
+                (timestr,ip,mac,delay) = line.rstrip().split(",")
+                timestamp = time.mktime(time.strptime(date + timestr, "%Y%m%d%H%M%S"))
+                if delay == "-":
+                    delayMs = None
+                else:
+                    delayMs = float(delay)
+                outf.write(packRecord(timestamp, ip, mac, delayMs))
+                nrecs += 1
+    return nrecs
+
+def usage():
+    print "Usage:", sys.argv[0], "tocsv <log.bin> [<out.csv>]"
+    print "      ", sys.argv[0], "fromcsv <log.csv> [<YYYYMMDD> [<out.bin>]]"
+    print "The date defaults to the one in the .csv file's name"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2:
+        usage()
+    (command, infile) = args[0:2]
+    (root, ext) = os.path.splitext(infile)
+    if command == "tocsv" and len(args) <= 3:
+        outfile = (args[2:3] or [root + ".csv"]) [0]
+        nrecs = binaryToCsv(infile, outfile)
+    elif command == "fromcsv" and len(args) <= 4:
+        if len(args) >= 3:
+            date = args[2]
+        else:
+            m = re.search("(\d{8})", os.path.basename(infile))
+            if m == None:
+                usage()
+            date = m.group(1)
+        outfile = (args[3:4] or [root + ".bin"]) [0]
+        nrecs = csvToBinary(infile, date, outfile)
+    else:
+        usage()
+    print "Wrote", nrecs, "records to", outfile
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+# Long-term storage of ping results, as fixed-size round-robin files
+# (in the style of RRDtool), one per target.
+#
+# Each file holds several archives at different resolutions, e.g. one
+# row per minute for two days, one per 15 minutes for 60 days and one per
+# hour for two years. A row is the count, total, minimum, maximum and
+# number lost of the pings in its time slot. Rows are reused in a ring,
+# so a file never grows once created.
+
+# This code is placed in the public domain by its author, Ian Harvey
+# It comes with NO WARRANTY.
+
+import os
+import re
+import time
+import mmap
+import struct
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mkgraph import TimeSeries
+
+# Default archives, as (seconds per row, number of rows)
+DEFAULT_ARCHIVES = [ (60,   2*24*60),     # 1 minute for 2 days
+                     (900,  60*24*4),     # 15 minutes for 60 days
+                     (3600, 2*365*24) ]   # 1 hour for 2 years
+
+class RollupFile:
+    '''One target's round-robin file, memory-mapped while it is open. A
+       file with a different layout is moved aside, not overwritten.'''
+    MAGIC = "PGRR"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIId")   # magic, version, archive count, last update time
+    ARCHIVE = struct.Struct("<II")     # seconds per row, number of rows
+    ROW = struct.Struct("<IIIfff")     # slot, count, lost, total, min, max
+    ROW_FIELDS = [ ('slot', '<u4'), ('count', '<u4'), ('lost', '<u4'),
+                   ('total', '<f4'), ('min', '<f4'), ('max', '<f4') ]
+
+    def __init__(self, filename, archives=DEFAULT_ARCHIVES):
+        self.filename = filename
+        self.archives = []
+        offset = self.HEADER.size + len(archives) * self.ARCHIVE.size
+        for (step, rows) in archives:
+            self.archives.append( (step, rows, offset) )
+            offset += rows * self.ROW.size
+        self.size = offset
+        self.layout = list(archives)
+        self.mm = None
+        self.open()
+
+    def open(self):
+        '''Maps the file, if it is not already, creating it if need be'''
+        if self.mm != None:
+            return
+        if not self._open(self.layout):
+            if os.path.exists(self.filename):
+                oldname = "%s.%s.old" % (self.filename, time.strftime("%Y%m%d-%H%M%S"))
+                print "Rollup file", self.filename, "has a different layout; moving it to", oldname
+                os.rename(self.filename, oldname)
+            self._create(self.layout)
+            if not self._open(self.layout):
+                raise IOError("Cannot open rollup file " + self.filename)
+        self.lastUpdate = self.HEADER.unpack_from(self.mm, 0) [3]
+
+    def _open(self, archives):
+        '''Maps the file, returning False if it is missing or has a
+           different layout'''
+        if not os.path.isfile(self.filename) or os.path.getsize(self.filename) != self.size:
+            return False
+        with open(self.filename, "r+b") as f:
+            self.mm = mmap.mmap(f.fileno(), self.size)
+        (magic, version, narchives, lastUpdate) = self.HEADER.unpack_from(self.mm, 0)
+        layout = [ self.ARCHIVE.unpack_from(self.mm, self.HEADER.size + i*self.ARCHIVE.size)
+                   for i in range(narchives) ]
+        if magic != self.MAGIC or version != self.VERSION or layout != list(archives):
+            self.mm.close()
+            self.mm = None
+            return False
+        return True
+
+    def _create(self, archives):
+        print "Creating", self.filename
+        tempname = self.filename + ".tmp"
+        with open(tempname, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(archives), 0.0))
+            for (step, rows) in archives:
+                f.write(self.ARCHIVE.pack(step, rows))
+            f.truncate(self.size)
+        os.rename(tempname, self.filename)
+
+    def close(self):
+        '''Unmaps the file; open() maps it again'''
+        if self.mm != None:
+            self.mm.close()
+            self.mm = None
+
+    def addPoint(self, timestamp, delay):
+        '''Adds one ping result; delay is None if it was lost. Points no
+           later than the last one added are ignored, so it is safe to
+           re-read a log.'''
+        if timestamp <= self.lastUpdate:
+            return False
+        for (step, rows, offset) in self.archives:
+            slot = int(timestamp // step)
+            pos = offset + (slot % rows) * self.ROW.size
+            (rowSlot, count, lost, total, lo, hi) = self.ROW.unpack_from(self.mm, pos)
+            if rowSlot != slot:
+                # Reusing the row
+                (count, lost, total, lo, hi) = (0, 0, 0.0, float("inf"), 0.0)
+            if delay is None:
+                lost += 1
+            else:
+                count += 1
+                total += delay
+                lo = min(lo, delay)
+                hi = max(hi, delay)
+            self.ROW.pack_into(self.mm, pos, slot, count, lost, total, lo, hi)
+        self.lastUpdate = timestamp
+        struct.pack_into("<d", self.mm, self.HEADER.size - 8, timestamp)
+        return True
+
+    def addColumn(self, timestamps, delays):
+        '''Adds many ping results, in time order, at once; delays[i] is NaN
+           for a lost ping. Each row is updated once, however many points
+           fall in it. Points no later than the last one added are ignored,
+           as by addPoint().'''
+        if numpy is None:
+            for (timestamp, delay) in zip(timestamps, delays):
+                if delay != delay:
+                    delay = None
+                self.addPoint(timestamp, delay)
+            return
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        delays = numpy.asarray(delays, dtype=float)
+        new = timestamps > self.lastUpdate
+        (timestamps, delays) = (timestamps[new], delays[new])
+        if len(timestamps) == 0:
+            return
+        isLost = numpy.isnan(delays)
+        got = ~isLost
+        for (step, rows, offset) in self.archives:
+            slots = (timestamps // step).astype(numpy.int64)
+            # In time order, each slot's points are a run
+            starts = numpy.flatnonzero(numpy.concatenate( ([True], slots[1:] != slots[:-1]) ))
+            runSlots = slots[starts]
+            count = numpy.add.reduceat(got.astype(int), starts)
+            lost = numpy.add.reduceat(isLost.astype(int), starts)
+            total = numpy.add.reduceat(numpy.where(got, delays, 0.0), starts)
+            lo = numpy.minimum.reduceat(numpy.where(got, delays, numpy.inf), starts)
+            hi = numpy.maximum.reduceat(numpy.where(got, delays, 0.0), starts)
+            # Only the last 'rows' slots fit in the ring
+            keep = runSlots > runSlots[-1] - rows
+            (runSlots, count, lost, total, lo, hi) = [ a[keep] for a in (runSlots, count, lost, total, lo, hi) ]
+
+            table = numpy.frombuffer(self.mm, dtype=numpy.dtype(self.ROW_FIELDS), count=rows, offset=offset)
+            pos = runSlots % rows
+            old = table[pos]
+            same = (old['slot'] == runSlots)
+            table['count'][pos] = numpy.where(same, old['count'], 0) + count
+            table['lost'][pos] = numpy.where(same, old['lost'], 0) + lost
+            table['total'][pos] = numpy.where(same, old['total'], 0.0) + total
+            table['min'][pos] = numpy.minimum(numpy.where(same, old['min'], numpy.inf), lo)
+            table['max'][pos] = numpy.maximum(numpy.where(same, old['max'], 0.0), hi)
+            table['slot'][pos] = runSlots
+            del table
+        self.lastUpdate = float(timestamps[-1])
+        struct.pack_into("<d", self.mm, self.HEADER.size - 8, self.lastUpdate)
+
+    def getSeries(self, startTime, endTime, length):
+        '''Returns a TimeSeries with 'length' equal buckets from startTime to
+           endTime, from the finest archive which reaches back to startTime.
+           Only counts, totals, mins, maxs and lost are filled in.'''
+        hours = (endTime - startTime) / 3600.0
+        series = TimeSeries(length / hours, hours)
+        latest = max(self.lastUpdate, endTime)
+        (step, rows, offset) = self.archives[-1]
+        for archive in self.archives:
+            if latest - archive[0]*archive[1] <= startTime:
+                (step, rows, offset) = archive
+                break
+
+        first = max(int(startTime // step), int(latest // step) - rows + 1)
+        for slot in xrange(first, int(endTime // step) + 1):
+            pos = offset + (slot % rows) * self.ROW.size
+            (rowSlot, count, lost, total, lo, hi) = self.ROW.unpack_from(self.mm, pos)
+            if rowSlot != slot:
+                continue
+            i = int((slot*step - startTime) * length / (endTime - startTime))
+            if i < 0 or i >= length:
+                continue
+            series.lost[i] += lost
+            if count > 0:
+                series.counts[i] += count
+                series.totals[i] += total
+                series.mins[i] = min(series.mins[i], lo)
+                series.maxs[i] = max(series.maxs[i], hi)
+        return series
+
+class RollupStore:
+    '''The RollupFiles for all targets, in one directory. Only the maxOpen
+       most recently used are kept mapped, so that a large network does
+       not use up the address space of a 32-bit machine.'''
+    def __init__(self, path, archives=DEFAULT_ARCHIVES, maxOpen=64):
+        self.path = path
+        self.archives = archives
+        self.maxOpen = maxOpen
+        self.files = {}
+        self.mapped = collections.OrderedDict() # Target -> RollupFile, least recently used first
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def getFileName(self, target):
+        return os.path.join(self.path, re.sub("[^0-9A-Za-z.-]", "_", target) + ".rrd")
+
+    def getFile(self, target):
+        '''Returns the target's RollupFile, mapped'''
+        rf = self.files.get(target)
+        if rf is None:
+            rf = RollupFile(self.getFileName(target), self.archives)
+            self.files[target] = rf
+        else:
+            rf.open()
+        self.mapped.pop(target, None)
+        self.mapped[target] = rf
+        while len(self.mapped) > self.maxOpen:
+            self.mapped.popitem(last=False) [1].close()
+        return rf
+
+    def addPoint(self, target, timestamp, delay):
+        return self.getFile(target).addPoint(timestamp, delay)
+
+    def addColumn(self, target, timestamps, delays):
+        return self.getFile(target).addColumn(timestamps, delays)
+
+    def getLastUpdate(self, target):
+        rf = self.files.get(target)
+        if rf is None:
+            rf = self.getFile(target)
+        return rf.lastUpdate
+
+    def getSeries(self, target, startTime, endTime, length):
+        return self.getFile(target).getSeries(startTime, endTime, length)
+
+    def close(self):
+        for rf in self.files.values():
+            rf.close()
+        self.files = {}
+        self.mapped.clear()
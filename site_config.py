@@ -31,6 +31,18 @@ known_macs = {
 # File used to communicate between ping.py and pinggraph.py
 input_file = "/tmp/pinglog-%(date)s.csv"
 
+# Format of the log written by ping.py: "csv" (input_file, above) or
+# "binary" (binary_input_file, which is smaller and faster to read).
+# pinglog.py converts between them.
+log_format = "csv"
+binary_input_file = "/tmp/pinglog-%(date)s.bin"
+
+# Unix socket on which pinggraph.py hears from ping.py each time it adds
+# to the log, so that graphs are updated straight away; or None for
+# pinggraph.py to look at the log every graph_interval seconds. Both
+# programs must be able to get at it.
+notify_socket = None
+
 # Directory used to hold generated results;
 # must be writable by the user running pinggraph.py
 output_path = "/var/www/pages/pinger"
@@ -38,9 +50,82 @@ output_path = "/var/www/pages/pinger"
 # Name of page to be created showing results
 page_name = "netstats.html"
 
+# SQLite database in which pinggraph.py records when each device was
+# first and last seen; must be writable by the user running pinggraph.py.
+# If last_seen_file names an old pickled last-seen file, its contents
+# are copied in when the database is first made.
+last_seen_db = "/var/www/pages/pinger/lastseen.db"
+
 # Text to include in page linking to stylesheet.
 stylesheet='<link rel=stylesheet type="text/css" href="/default.css">'
 
 # Name of a valid font file to use when plotting charts
 graph_font = "/usr/share/fonts/truetype/ttf-dejavu/DejaVuSansMono.ttf"
 
+# Rate (packets per second) at which ping.py sweeps the address range
+# looking for devices
+sweep_rate = 50
+
+# Interval (seconds) between measurements of the devices found
+measure_interval = 30
+
+# How long (seconds) to wait for each ping's reply. The wait for each
+# device adapts to how quickly it has been answering, between these
+# limits; devices not yet seen get the maximum.
+ping_timeout_min = 0.2
+ping_timeout_max = 2.0
+
+# Number of processes ping.py shares the pinging between; each sends
+# to part of the address range with its own socket. More than 1 is only
+# worthwhile for ranges of tens of thousands of addresses, or more.
+ping_shards = 1
+
+# Addresses with no device are looked at again after each measurement,
+# but less and less often the longer they stay quiet: after
+# rescan_min_interval seconds, then twice that, and so on up to
+# rescan_max_interval. Addresses in known_ips, or in the ARP table, are
+# looked at at least every rescan_priority_interval. A new device is
+# found within rescan_max_interval of turning up.
+rescan_min_interval = 30
+rescan_max_interval = 3600
+rescan_priority_interval = 300
+
+# Number of measurements in a row a device must miss before ping.py
+# decides it has gone, stops measuring it and looks for it again in the
+# rescans above. Until then its losses are logged against its last MAC
+# address.
+lost_limit = 5
+
+# How pinggraph.py puts the graphs on the page: "png" writes a PNG file
+# for each; "atlas" puts them all together in a few palette PNG files
+# (atlas-000.png and so on), which the page cuts up with CSS; "svg" puts
+# them in the page itself. The last two save a lot of file writes and
+# HTTP requests when there are many devices.
+graph_output = "png"
+
+# Number of worker processes pinggraph.py uses to draw graphs;
+# 0 draws them all in the main process
+graph_workers = 0
+
+# Directory for long-term round-robin history files, one per device,
+# or None to keep only each day's log. Must be writable by the user
+# running pinggraph.py
+rollup_path = None
+
+# Directory where ping.py and pinggraph.py write their timings and
+# counts, as ping.prom and pinggraph.prom in the Prometheus text format
+# (e.g. node_exporter's textfile collector directory), or None not to
+# write them. pinggraph.py shows some of them at the foot of the page.
+metrics_path = None
+
+# Where "pinggraph.py --serve" listens for browsers ("" for all
+# interfaces), and how many drawn graphs it keeps in memory. When
+# serving, graphs are drawn only when asked for, instead of every time
+# the log changes; pinggraph.py --serve <port> overrides serve_port.
+serve_address = ""
+serve_port = 8080
+graph_cache_size = 500
+
+# Longer-term graphs to show on the page, if rollup_path is set;
+# any of "week", "month" and "year"
+history_graphs = [ "week", "month", "year" ]